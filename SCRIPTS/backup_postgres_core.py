@@ -0,0 +1,940 @@
+"""Export des tables PostgreSQL/PostGIS, sans interface graphique.
+
+Utilisé par backup_postgres_db.py (console QGIS) et par backup_postgres_headless.py
+(exécution planifiée) : ce module n'importe ni QtWidgets ni qgis.gui.
+"""
+from qgis.core import (
+    QgsCoordinateTransformContext,
+    QgsDataSourceUri,
+    QgsExpression,
+    QgsFeatureRequest,
+    QgsVectorLayer,
+    QgsVectorFileWriter,
+    QgsWkbTypes
+)
+from osgeo import gdal, ogr
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import fnmatch
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import psycopg2
+
+def connect_pg(params):
+    """Connexion psycopg2 ; `params` donne soit un service pg_service.conf, soit hôte, port, base, etc."""
+    if params.get("service"):
+        return psycopg2.connect(
+            service=params["service"],
+            **{key: params[key] for key in ("dbname", "user", "password") if params.get(key)}
+        )
+    return psycopg2.connect(
+        host=params["host"],
+        port=params["port"],
+        dbname=params["dbname"],
+        user=params["user"],
+        password=params["password"]
+    )
+
+TableInfo = namedtuple(
+    "TableInfo", "schema table geom_column geom_type srid primary_key row_estimate size"
+)
+
+CATALOG_SQL = """
+    SELECT DISTINCT ON (n.nspname, c.relname)
+        n.nspname, c.relname, gc.f_geometry_column, gc.type, gc.coord_dimension, gc.srid,
+        (SELECT array_agg(a.attname::text ORDER BY array_position(i.indkey::int2[], a.attnum))
+         FROM pg_index i
+         JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+         WHERE i.indrelid = c.oid AND i.indisprimary),
+        c.reltuples::bigint, pg_total_relation_size(c.oid)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN geometry_columns gc ON gc.f_table_schema = n.nspname AND gc.f_table_name = c.relname
+    WHERE c.relkind IN ('r', 'p')
+    AND n.nspname NOT IN ('pg_catalog', 'information_schema', 'topology')
+    AND n.nspname NOT LIKE 'pg_toast%'
+    AND has_table_privilege(c.oid, 'SELECT')
+    ORDER BY n.nspname, c.relname, gc.f_geometry_column;
+"""
+
+CATALOG_MAX_AGE = 300  # secondes
+_catalog_cache = {}
+
+def _geometry_type_name(geom_type, coord_dimension):
+    """Type de geometry_columns (MULTIPOLYGON, dimension 3...) en nom WKT (MultiPolygonZ)."""
+    if not geom_type or geom_type.upper() == "GEOMETRY":
+        return None
+    if coord_dimension == 3 and not geom_type.endswith("M"):
+        return geom_type + "Z"
+    if coord_dimension == 4:
+        return geom_type + "ZM"
+    return geom_type
+
+def get_catalog(cur, params, refresh=False):
+    """Instantané du catalogue : {(schéma, table): TableInfo}, en une seule requête.
+
+    Pour chaque table : colonne, type et SRID de la géométrie, clé primaire, lignes
+    estimées (reltuples, None si la table n'a jamais été analysée) et taille sur disque
+    (table, index et TOAST). L'instantané est gardé CATALOG_MAX_AGE secondes par base.
+    """
+    cache_key = tuple(params.get(key) for key in ("service", "host", "port", "dbname", "user"))
+    cached = _catalog_cache.get(cache_key)
+    if cached and not refresh and time.monotonic() - cached[0] < CATALOG_MAX_AGE:
+        return cached[1]
+    cur.execute(CATALOG_SQL)
+    catalog = {}
+    for schema, table, geom_column, geom_type, coord_dimension, srid, primary_key, reltuples, size in cur.fetchall():
+        catalog[(schema, table)] = TableInfo(
+            schema, table, geom_column, _geometry_type_name(geom_type, coord_dimension), srid,
+            tuple(primary_key or ()), reltuples if reltuples >= 0 else None, size
+        )
+    _catalog_cache[cache_key] = (time.monotonic(), catalog)
+    print(f"[LOG] Catalogue : {len(catalog)} tables, dont {sum(1 for info in catalog.values() if info.geom_column)} spatiales")
+    return catalog
+
+def catalog_tables_by_schema(catalog):
+    result = {}
+    for schema, table in sorted(catalog):
+        result.setdefault(schema, []).append(table)
+    return result
+
+def count_rows(params, schema, table_name):
+    pg_conn = connect_pg(params)
+    try:
+        cur = pg_conn.cursor()
+        cur.execute(f"SELECT count(*) FROM {quote_ident(schema)}.{quote_ident(table_name)};")
+        return cur.fetchone()[0]
+    finally:
+        pg_conn.close()
+
+CHUNK_ROWS = 100000
+
+class RunReport:
+    """Mesures d'une sauvegarde : une entrée par table, totaux et rapport JSON.
+
+    `progress`, s'il est donné, est appelé avec (tables terminées, tables prévues)
+    après chaque table, depuis le fil d'exécution qui l'a exportée.
+    """
+
+    def __init__(self, total=0, progress=None):
+        self.total = total
+        self.progress = progress
+        self.tables = []
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now()
+        self.start = time.perf_counter()
+
+    def record(self, info, timings, output_bytes, error=None):
+        rows, write_s = timings["lignes"], timings["ecriture_s"]
+        entry = {
+            "table": f"{info.schema}.{info.table}",
+            "spatiale": bool(info.geom_column),
+            "taille_source": info.size,
+            "ouverture_s": round(timings["ouverture_s"], 3),
+            "ecriture_s": round(write_s, 3),
+            "lignes": rows,
+            "octets": output_bytes,
+            "lignes_s": round(rows / write_s) if rows and write_s else None,
+            "erreur": error,
+        }
+        with self.lock:
+            self.tables.append(entry)
+            done = len(self.tables)
+        if self.progress:
+            self.progress(done, self.total)
+
+    def totals(self):
+        elapsed = time.perf_counter() - self.start
+        rows = sum(entry["lignes"] or 0 for entry in self.tables)
+        output_bytes = sum(entry["octets"] or 0 for entry in self.tables)
+        return {
+            "tables": len(self.tables),
+            "erreurs": sum(1 for entry in self.tables if entry["erreur"]),
+            "duree_s": round(elapsed, 3),
+            "ouverture_s": round(sum(entry["ouverture_s"] for entry in self.tables), 3),
+            "ecriture_s": round(sum(entry["ecriture_s"] for entry in self.tables), 3),
+            "lignes": rows,
+            "octets": output_bytes,
+            "lignes_s": round(rows / elapsed) if elapsed else None,
+            "mo_s": round(output_bytes / 1e6 / elapsed, 2) if elapsed else None,
+        }
+
+    def write(self, path, **context):
+        """Écrit le rapport JSON ; les tables sont classées de la plus longue à la plus courte."""
+        report = {
+            "debut": self.started.isoformat(timespec="seconds"),
+            **context,
+            "totaux": self.totals(),
+            "tables": sorted(self.tables, key=lambda entry: entry["ecriture_s"], reverse=True),
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"[LOG] Rapport d'exécution écrit : {path}")
+        return report
+
+def written_rows(path, layer_name):
+    """Lignes d'une couche GeoPackage, d'après gpkg_ogr_contents (tenu à jour par OGR) si possible."""
+    db = sqlite3.connect(path)
+    try:
+        try:
+            row = db.execute(
+                "SELECT feature_count FROM gpkg_ogr_contents WHERE lower(table_name) = lower(?);", (layer_name,)
+            ).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row and row[0] is not None:
+            return row[0]
+        return db.execute(f"SELECT count(*) FROM {quote_ident(layer_name)};").fetchone()[0]
+    finally:
+        db.close()
+
+def is_export_successful(err):
+    """Compatibilité PyQGIS : l'export est réussi si 'err' vaut 0 ou (0, ...).
+
+    Seul le code de retour compte : un fichier présent sur le disque peut être celui
+    d'une sauvegarde précédente.
+    """
+    # QgsVectorFileWriter.NoError = 0
+    if isinstance(err, tuple):
+        # SQLite non spatial: (0, '') mais parfois aussi (0, None)
+        return len(err) > 0 and err[0] == 0
+    return err == 0
+
+COPY_BATCH_ROWS = 50000
+
+# Type déclaré dans SQLite (reconnu par OGR) selon le type PostgreSQL
+SQLITE_TYPES = {
+    "smallint": "INTEGER", "integer": "INTEGER", "bigint": "BIGINT", "boolean": "BOOLEAN",
+    "real": "REAL", "double precision": "REAL", "numeric": "REAL",
+    "date": "DATE", "timestamp without time zone": "DATETIME", "timestamp with time zone": "DATETIME",
+    "bytea": "BLOB",
+}
+
+# Dans un GeoPackage, seuls les types de la norme sont admis : INTEGER est sur 64 bits
+GPKG_TYPES = dict(SQLITE_TYPES, bigint="INTEGER")
+DATETIME_TYPES = ("timestamp without time zone", "timestamp with time zone")
+
+COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v", "\\": "\\"}
+COPY_ESCAPE_RE = re.compile(r"\\(x[0-9A-Fa-f]{1,2}|[0-7]{1,3}|.)")
+
+def _unescape_copy_value(value):
+    """Décode une valeur du format texte de COPY (\\N = NULL, séquences d'échappement)."""
+    if value == "\\N":
+        return None
+    if "\\" not in value:
+        return value
+    def replace(match):
+        seq = match.group(1)
+        if seq[0] == "x":
+            return chr(int(seq[1:], 16))
+        if seq[0].isdigit():
+            return chr(int(seq, 8))
+        return COPY_ESCAPES.get(seq, seq)
+    return COPY_ESCAPE_RE.sub(replace, value)
+
+def _convert_boolean(value):
+    return None if value is None else int(value == "t")
+
+def _convert_bytea(value):
+    return None if value is None else bytes.fromhex(value[2:])  # format hex : \\x...
+
+COPY_DATETIME_RE = re.compile(r"^(\d{4}-\d{2}-\d{2}) (\d{2}:\d{2}:\d{2})(?:\.(\d{1,6}))?(\+00)?$")
+
+def _convert_gpkg_datetime(value):
+    """Horodatage COPY (DateStyle ISO, fuseau UTC) vers le format DATETIME du GeoPackage.
+
+    « 2024-05-01 08:30:00.25+00 » devient « 2024-05-01T08:30:00.250Z », à la
+    milliseconde comme les couches écrites par OGR ; sans fuseau, pas de « Z ».
+    Les valeurs hors format (infinity, dates avant J.-C.) restent telles quelles.
+    """
+    if value is None:
+        return None
+    match = COPY_DATETIME_RE.match(value)
+    if match is None:
+        return value
+    date, clock, fraction, utc = match.groups()
+    return f"{date}T{clock}.{(fraction or '').ljust(3, '0')[:3]}{'Z' if utc else ''}"
+
+class SqliteCopyWriter:
+    """Fichier recevant le flux de COPY ... TO STDOUT (format texte) et l'insérant par lots dans SQLite."""
+
+    def __init__(self, sqlite_conn, insert_sql, converters, batch_rows=COPY_BATCH_ROWS):
+        self.sqlite_conn = sqlite_conn
+        self.insert_sql = insert_sql
+        self.converters = converters
+        self.batch_rows = batch_rows
+        self.buffer = b""
+        self.rows = []
+        self.row_count = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        *lines, self.buffer = (self.buffer + data).split(b"\n")
+        for line in lines:
+            values = [_unescape_copy_value(value) for value in line.decode("utf-8").split("\t")]
+            self.rows.append([convert(value) if convert else value for convert, value in zip(self.converters, values)])
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.rows:
+            self.sqlite_conn.executemany(self.insert_sql, self.rows)
+            self.row_count += len(self.rows)
+            self.rows = []
+
+def get_table_columns(cur, schema, table_name):
+    cur.execute("""
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position;
+    """, (schema, table_name))
+    return cur.fetchall()
+
+def get_primary_key(cur, schema, table_name):
+    cur.execute("""
+        SELECT array_agg(a.attname::text ORDER BY array_position(i.indkey::int2[], a.attnum))
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary;
+    """, (f"{quote_ident(schema)}.{quote_ident(table_name)}",))
+    row = cur.fetchone()
+    return tuple(row[0] or ()) if row else ()
+
+FID_COLUMN = "ogc_fid"
+INTEGER_TYPES = ("smallint", "integer", "bigint")
+
+def fid_column(columns, primary_key):
+    """Colonne FID (INTEGER PRIMARY KEY) de la table SQLite : (nom, True si c'est une colonne source).
+
+    Une clé primaire entière nommée ogc_fid (tables chargées par ogr2ogr) sert de FID ;
+    sinon la colonne ajoutée prend un nom libre parmi ogc_fid, ogc_fid_1, ...
+    """
+    types = {name.lower(): data_type for name, data_type in columns}
+    if len(primary_key) == 1 and primary_key[0].lower() == FID_COLUMN and types.get(FID_COLUMN) in INTEGER_TYPES:
+        return primary_key[0], True
+    name, i = FID_COLUMN, 0
+    while name in types:
+        i += 1
+        name = f"{FID_COLUMN}_{i}"
+    return name, False
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def copy_table_into(sqlite_conn, params, schema, table_name, layer_name, gpkg=False):
+    """Crée `layer_name` dans la base SQLite ouverte et y copie la table PostgreSQL.
+
+    Les lignes sont lues en flux par COPY ... TO STDOUT (psycopg2 copy_expert) et
+    insérées par lots ; la transaction est à la charge de l'appelant. Avec `gpkg`, la
+    table suit les types et le format DATETIME du GeoPackage. Retourne le nombre de
+    lignes copiées.
+    """
+    types = GPKG_TYPES if gpkg else SQLITE_TYPES
+    pg_conn = connect_pg(params)
+    try:
+        pg_conn.set_client_encoding("UTF8")
+        cur = pg_conn.cursor()
+        if gpkg:
+            # Horodatages en UTC et au format ISO, quels que soient les réglages du serveur
+            cur.execute("SET TIME ZONE 'UTC'; SET DateStyle TO ISO;")
+        columns = get_table_columns(cur, schema, table_name)
+        fid, from_source = fid_column(columns, get_primary_key(cur, schema, table_name))
+        column_defs = [
+            f"{quote_ident(name)} {'INTEGER PRIMARY KEY' if from_source and name == fid else types.get(data_type, 'TEXT')}"
+            for name, data_type in columns
+        ]
+        if not from_source:
+            column_defs.insert(0, f"{quote_ident(fid)} INTEGER PRIMARY KEY")
+        sqlite_conn.execute(f"CREATE TABLE {quote_ident(layer_name)} ({', '.join(column_defs)});")
+        insert_sql = (
+            f"INSERT INTO {quote_ident(layer_name)} ({', '.join(quote_ident(name) for name, _ in columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))});"
+        )
+        converters = [
+            _convert_boolean if data_type == "boolean" else _convert_bytea if data_type == "bytea"
+            else _convert_gpkg_datetime if gpkg and data_type in DATETIME_TYPES else None
+            for _, data_type in columns
+        ]
+        writer = SqliteCopyWriter(sqlite_conn, insert_sql, converters)
+        cur.copy_expert(
+            f"COPY {quote_ident(schema)}.{quote_ident(table_name)} TO STDOUT WITH (FORMAT text);", writer
+        )
+        writer.flush()
+    finally:
+        pg_conn.close()
+    return writer.row_count
+
+def export_table_copy(params, schema, table_name, out_path):
+    """Exporte une table non spatiale vers SQLite sans passer par les entités QGIS.
+
+    Toutes les lignes sont insérées dans une seule transaction ; le fichier n'est mis
+    en place qu'une fois complet. Retourne le nombre de lignes exportées.
+    """
+    layer_name = f"{schema}_{table_name}".lower()
+    tmp_path = out_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    sqlite_conn = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        sqlite_conn.execute("PRAGMA journal_mode = OFF;")
+        sqlite_conn.execute("PRAGMA synchronous = OFF;")
+        sqlite_conn.execute("BEGIN;")
+        rows = copy_table_into(sqlite_conn, params, schema, table_name, layer_name)
+        sqlite_conn.execute("COMMIT;")
+    finally:
+        sqlite_conn.close()
+    os.replace(tmp_path, out_path)
+    return rows
+
+def table_output_path(output_folder, schema, table_name, geom_column):
+    extension = "gpkg" if geom_column else "sqlite"
+    return os.path.join(output_folder, f"{schema}_{table_name}.{extension}")
+
+def checkpoint_path(out_path, layer_name):
+    return os.path.join(os.path.dirname(out_path), f"{layer_name}.checkpoint.json")
+
+def _write_chunk(layer, request, out_path, layer_name, append, layer_options=()):
+    """Écrit une page d'entités dans le GeoPackage ; retourne (lignes, dernière clé, erreur).
+
+    Le fichier est refermé à la fin de la page : ce qui est écrit est sur le disque
+    avant que le point de contrôle ne soit mis à jour.
+    """
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = "GPKG"
+    options.fileEncoding = "UTF-8"
+    options.layerName = layer_name
+    options.layerOptions = list(layer_options)
+    options.actionOnExistingFile = (
+        QgsVectorFileWriter.AppendToLayerNoNewFields if append else QgsVectorFileWriter.CreateOrOverwriteLayer
+    )
+    writer = QgsVectorFileWriter.create(
+        out_path, layer.fields(), layer.wkbType(), layer.crs(), QgsCoordinateTransformContext(), options
+    )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        return 0, None, writer.errorMessage()
+    features = list(layer.getFeatures(request))
+    if features and not writer.addFeatures(features):
+        error = writer.errorMessage()
+        del writer
+        return 0, None, error
+    del writer
+    return len(features), (features[-1].attributes() if features else None), None
+
+def export_layer_chunked(layer, out_path, layer_name, chunk_rows, layer_options=()):
+    """Exporte la couche par pages de `chunk_rows` entités triées sur la clé primaire.
+
+    Chaque page est lue avec « clé > dernière clé écrite » (pagination par clé, sans
+    OFFSET), ajoutée au GeoPackage puis notée dans un fichier de point de contrôle.
+    Si ce fichier existe au lancement, l'export reprend après la dernière page notée :
+    les lignes d'une page interrompue sont d'abord retirées du GeoPackage. Retourne
+    (lignes écrites, erreur), ou None si la couche n'a pas de clé primaire simple.
+    """
+    key_indexes = layer.primaryKeyAttributes()
+    if len(key_indexes) != 1:
+        return None
+    key_index = key_indexes[0]
+    key_name = layer.fields().at(key_index).name()
+    checkpoint = checkpoint_path(out_path, layer_name)
+
+    last_key, written = None, 0
+    if os.path.exists(checkpoint) and os.path.exists(out_path):
+        with open(checkpoint, encoding="utf-8") as f:
+            state = json.load(f)
+        last_key, written = state["derniere_cle"], state["lignes"]
+        with sqlite3.connect(out_path) as db:
+            if last_key is None:
+                db.execute(f"DELETE FROM {quote_ident(layer_name)};")
+            else:
+                db.execute(f"DELETE FROM {quote_ident(layer_name)} WHERE {quote_ident(key_name)} > ?;", (last_key,))
+        print(f"[LOG] Reprise de {layer.name()} après la clé {last_key} ({written} lignes déjà écrites)")
+
+    append = os.path.exists(checkpoint) and os.path.exists(out_path)
+    while True:
+        request = QgsFeatureRequest()
+        if last_key is not None:
+            request.setFilterExpression(
+                f"{QgsExpression.quotedColumnRef(key_name)} > {QgsExpression.quotedValue(last_key)}"
+            )
+        request.addOrderBy(QgsExpression.quotedColumnRef(key_name), True)
+        request.setLimit(chunk_rows)
+        rows, last_attributes, error = _write_chunk(layer, request, out_path, layer_name, append, layer_options)
+        if error:
+            return written, error
+        if rows == 0 and append:
+            break
+        if rows:
+            last_key = last_attributes[key_index]
+        written += rows
+        append = True
+        with open(checkpoint + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"derniere_cle": last_key, "lignes": written}, f)
+        os.replace(checkpoint + ".tmp", checkpoint)
+        print(f"[LOG] {layer.name()} : {written} lignes écrites")
+        if rows < chunk_rows:
+            break
+    os.remove(checkpoint)
+    return written, None
+
+def postgres_layer(params, info):
+    """Couche postgres d'une table du catalogue.
+
+    Type et SRID de la géométrie et clé primaire viennent de l'instantané du catalogue :
+    le fournisseur n'a pas à les redemander au serveur à l'ouverture de chaque couche.
+    """
+    uri = QgsDataSourceUri()
+    if params.get("service"):
+        uri.setConnection(params["service"], params.get("dbname", ""), params.get("user", ""), params.get("password", ""))
+    else:
+        uri.setConnection(
+            params["host"],
+            params["port"],
+            params["dbname"],
+            params["user"],
+            params["password"]
+        )
+    key_column = ",".join(quote_ident(name) for name in info.primary_key)
+    uri.setDataSource(info.schema, info.table, info.geom_column, "", key_column)
+    if info.geom_column and info.geom_type and info.srid:
+        uri.setWkbType(QgsWkbTypes.parseType(info.geom_type))
+        uri.setSrid(str(info.srid))
+    uri.setUseEstimatedMetadata(True)
+    return QgsVectorLayer(uri.uri(), f"{info.schema}.{info.table}", "postgres")
+
+def export_table(params, info, output_folder, chunk_rows=0, report=None):
+    """Exporte une table vers un fichier ; retourne None si l'export a réussi, sinon le message d'erreur.
+
+    Chaque appel crée sa propre couche : le fournisseur postgres ouvre une connexion
+    par fil d'exécution, ce qui permet d'exporter plusieurs tables en parallèle.
+    Avec `chunk_rows`, les tables spatiales sont exportées par pages reprenables
+    (voir export_layer_chunked). Les mesures de la table sont ajoutées à `report`.
+    """
+    timings = {"ouverture_s": 0.0, "ecriture_s": 0.0, "lignes": None}
+    out_path = table_output_path(output_folder, info.schema, info.table, info.geom_column)
+    error = _export_table(params, info, out_path, chunk_rows, timings)
+    if report is not None:
+        report.record(info, timings, os.path.getsize(out_path) if os.path.exists(out_path) else None, error)
+    return error
+
+def _export_table(params, info, out_path, chunk_rows, timings):
+    schema, table_name, geom_column = info.schema, info.table, info.geom_column
+    try:
+        if not geom_column:
+            # Table non spatiale : flux COPY directement vers SQLite, sans entités QGIS
+            print(f"[LOG] Export de {schema}.{table_name} vers {out_path} (COPY vers SQLite)")
+            start = time.perf_counter()
+            rows = export_table_copy(params, schema, table_name, out_path)
+            timings.update(ecriture_s=time.perf_counter() - start, lignes=rows)
+            print(f"[SUCCES] {schema}.{table_name} exportée en SQLite ({rows} lignes).")
+            return None
+
+        start = time.perf_counter()
+        layer = postgres_layer(params, info)
+        valid = layer.isValid()
+        timings["ouverture_s"] = time.perf_counter() - start
+        export_format = "GPKG"
+
+        print(f"[LOG] Export de {schema}.{table_name} vers {out_path} (format {export_format})")
+        if not valid:
+            print(f"[ERREUR] Couche invalide ou inaccessible : {schema}.{table_name}")
+            return f"Invalide ou inaccessible : {schema}.{table_name}"
+        start = time.perf_counter()
+        if chunk_rows:
+            chunked = export_layer_chunked(layer, out_path, f"{schema}_{table_name}", chunk_rows)
+            if chunked is not None:
+                rows, error = chunked
+                timings.update(ecriture_s=time.perf_counter() - start, lignes=rows)
+                if error:
+                    print(f"[ERREUR] Export {schema}.{table_name} interrompu après {rows} lignes : {error}")
+                    return f"Export interrompu pour {schema}.{table_name} après {rows} lignes (reprise possible) : {error}"
+                print(f"[SUCCES] {schema}.{table_name} exportée en {export_format} ({rows} lignes).")
+                return None
+            print(f"[LOG] {schema}.{table_name} sans clé primaire simple : export d'un bloc")
+        checkpoint = checkpoint_path(out_path, f"{schema}_{table_name}")
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        # Écriture dans un fichier temporaire mis en place seulement si l'export réussit :
+        # un export en échec laisse intacte la sauvegarde précédente
+        tmp_path = f"{os.path.splitext(out_path)[0]}.tmp.gpkg"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = export_format
+        options.fileEncoding = "UTF-8"
+        options.layerName = f"{schema}_{table_name}"
+        err = QgsVectorFileWriter.writeAsVectorFormatV3(layer, tmp_path, QgsCoordinateTransformContext(), options)
+        timings["ecriture_s"] = time.perf_counter() - start
+        if not is_export_successful(err):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            print(f"[ERREUR] Export {schema}.{table_name} ({export_format}) : code {err}")
+            return f"Erreur d'export pour {schema}.{table_name} ({export_format}) : {err}"
+        os.replace(tmp_path, out_path)
+        timings["lignes"] = written_rows(out_path, f"{schema}_{table_name}")
+        print(f"[SUCCES] {schema}.{table_name} exportée en {export_format} ({timings['lignes']} lignes).")
+        return None
+    except Exception as e:
+        print(f"[EXCEPTION] {schema}.{table_name} - {e}")
+        return f"Erreur pour {schema}.{table_name} : {e}"
+
+def export_tables(params, selected, catalog, output_folder, workers=1, chunk_rows=0, report=None):
+    """Exporte les tables sélectionnées avec `workers` exports simultanés.
+
+    Les tables sont lancées de la plus grosse à la plus petite (taille estimée dans le
+    catalogue), ce qui évite qu'une grosse table commencée en dernier allonge la durée
+    totale. Retourne un dictionnaire {(schéma, table): None ou message d'erreur} dans
+    l'ordre de sélection.
+    """
+    schedule = sorted(selected, key=lambda t: catalog[t].size or 0, reverse=True)
+    print(f"[LOG] Export de {len(schedule)} tables avec {workers} exports simultanés")
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            table: pool.submit(export_table, params, catalog[table], output_folder, chunk_rows, report)
+            for table in schedule
+        }
+    return {table: futures[table].result() for table in selected}
+
+GPKG_LAYER_OPTIONS = ("SPATIAL_INDEX=NO",)
+
+def _register_attribute_table(db, layer_name):
+    """Déclare une table non spatiale du GeoPackage comme table attributaire (gpkg_contents)."""
+    db.execute("DELETE FROM gpkg_contents WHERE table_name = ?;", (layer_name,))
+    db.execute(
+        "INSERT INTO gpkg_contents (table_name, data_type, identifier, last_change) "
+        "VALUES (?, 'attributes', ?, strftime('%Y-%m-%dT%H:%M:%fZ', 'now'));",
+        (layer_name, layer_name)
+    )
+
+def _drop_gpkg_table(db, layer_name):
+    db.execute(f"DROP TABLE IF EXISTS {quote_ident(layer_name)};")
+    db.execute("DELETE FROM gpkg_contents WHERE table_name = ?;", (layer_name,))
+
+def export_table_to_gpkg(params, info, gpkg_path, chunk_rows=0, timings=None):
+    """Écrit une table comme couche du GeoPackage commun ; retourne (couche, lignes source, erreur).
+
+    Les couches spatiales sont créées sans index spatial (SPATIAL_INDEX=NO) : les index
+    sont construits en une fois à la fin par build_spatial_indexes. Les tables non
+    spatiales passent par COPY et deviennent des tables attributaires. Les durées
+    d'ouverture et d'écriture sont notées dans `timings`.
+    """
+    timings = {} if timings is None else timings
+    schema, table_name, geom_column = info.schema, info.table, info.geom_column
+    layer_name = f"{schema}_{table_name}"
+    if not geom_column:
+        layer_name = layer_name.lower()
+        start = time.perf_counter()
+        db = sqlite3.connect(gpkg_path, isolation_level=None)
+        try:
+            db.execute("PRAGMA synchronous = OFF;")
+            db.execute("BEGIN;")
+            _drop_gpkg_table(db, layer_name)
+            rows = copy_table_into(db, params, schema, table_name, layer_name, gpkg=True)
+            _register_attribute_table(db, layer_name)
+            db.execute("COMMIT;")
+        finally:
+            db.close()
+        timings["ecriture_s"] = time.perf_counter() - start
+        return layer_name, rows, None
+
+    start = time.perf_counter()
+    layer = postgres_layer(params, info)
+    valid = layer.isValid()
+    timings["ouverture_s"] = time.perf_counter() - start
+    if not valid:
+        return layer_name, None, f"Invalide ou inaccessible : {schema}.{table_name}"
+    # Compte exact : avec les métadonnées estimées, featureCount() ne donne que reltuples
+    source_rows = count_rows(params, schema, table_name)
+    start = time.perf_counter()
+    if chunk_rows:
+        chunked = export_layer_chunked(layer, gpkg_path, layer_name, chunk_rows, GPKG_LAYER_OPTIONS)
+        if chunked is not None:
+            timings["ecriture_s"] = time.perf_counter() - start
+            return layer_name, source_rows, chunked[1]
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = "GPKG"
+    options.fileEncoding = "UTF-8"
+    options.layerName = layer_name
+    options.layerOptions = list(GPKG_LAYER_OPTIONS)
+    options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+    err = QgsVectorFileWriter.writeAsVectorFormatV3(layer, gpkg_path, QgsCoordinateTransformContext(), options)
+    timings["ecriture_s"] = time.perf_counter() - start
+    if err[0] != QgsVectorFileWriter.NoError:
+        return layer_name, source_rows, f"Erreur d'export pour {schema}.{table_name} (GPKG) : {err[1]}"
+    return layer_name, source_rows, None
+
+def build_spatial_indexes(gpkg_path, layer_names):
+    """Construit en une passe l'index spatial (R-tree) de chaque couche spatiale écrite."""
+    ds = ogr.Open(gpkg_path, update=1)
+    try:
+        for layer_name in layer_names:
+            layer = ds.GetLayerByName(layer_name)
+            if layer is None or layer.GetGeomType() == ogr.wkbNone:
+                continue
+            geom_column = layer.GetGeometryColumn()
+            result = ds.ExecuteSQL(f"SELECT gpkgAddSpatialIndex('{layer_name.replace(chr(39), chr(39) * 2)}', "
+                                   f"'{geom_column.replace(chr(39), chr(39) * 2)}')")
+            if result is not None:
+                ds.ReleaseResultSet(result)
+            print(f"[LOG] Index spatial construit : {layer_name}")
+    finally:
+        ds = None
+
+def gpkg_integrity_summary(gpkg_path, source_rows_by_layer):
+    """Compare, couche par couche, les lignes source et les lignes écrites, puis vérifie le fichier.
+
+    Retourne (lignes du résumé, True si tout concorde).
+    """
+    lines, ok = [], True
+    db = sqlite3.connect(gpkg_path)
+    try:
+        for layer_name, source_rows in source_rows_by_layer.items():
+            written = db.execute(f"SELECT count(*) FROM {quote_ident(layer_name)};").fetchone()[0]
+            status = "OK" if source_rows is None or written == source_rows else "ÉCART"
+            ok = ok and status == "OK"
+            lines.append(f"{layer_name} : source {source_rows if source_rows is not None else '?'}, "
+                         f"écrites {written} [{status}]")
+        check = db.execute("PRAGMA integrity_check;").fetchone()[0]
+    finally:
+        db.close()
+    ok = ok and check == "ok"
+    lines.append(f"PRAGMA integrity_check : {check}")
+    for line in lines:
+        print(f"[LOG] {line}")
+    return lines, ok
+
+def export_tables_gpkg(params, selected, catalog, gpkg_path, chunk_rows=0, report=None):
+    """Exporte les tables sélectionnées comme couches d'un seul GeoPackage.
+
+    Un GeoPackage n'accepte qu'un écrivain à la fois : les tables sont écrites l'une
+    après l'autre, chacune dans une grande transaction, et les index spatiaux sont
+    construits à la fin. Retourne ({(schéma, table): None ou erreur}, lignes du résumé,
+    True si le résumé d'intégrité concorde).
+    """
+    if not os.path.exists(gpkg_path):
+        ogr.GetDriverByName("GPKG").CreateDataSource(gpkg_path)
+    # Écritures sans attente de synchronisation disque et avec un grand cache SQLite
+    gdal.SetConfigOption("OGR_SQLITE_SYNCHRONOUS", "OFF")
+    gdal.SetConfigOption("OGR_SQLITE_CACHE", "512")
+    results, source_rows_by_layer, spatial_layers = {}, {}, []
+    try:
+        for schema, table_name in selected:
+            info = catalog[(schema, table_name)]
+            print(f"[LOG] Export de {schema}.{table_name} dans {gpkg_path}")
+            timings = {"ouverture_s": 0.0, "ecriture_s": 0.0, "lignes": None}
+            size_before = os.path.getsize(gpkg_path)
+            try:
+                layer_name, source_rows, error = export_table_to_gpkg(params, info, gpkg_path, chunk_rows, timings)
+            except Exception as e:
+                layer_name, source_rows, error = None, None, f"Erreur pour {schema}.{table_name} : {e}"
+            results[(schema, table_name)] = error
+            if report is not None:
+                # Octets : croissance du fichier commun pendant l'écriture de la couche
+                timings["lignes"] = None if error else source_rows
+                report.record(info, timings, os.path.getsize(gpkg_path) - size_before, error)
+            if error:
+                print(f"[ERREUR] {error}")
+                continue
+            print(f"[SUCCES] {schema}.{table_name} écrite dans la couche {layer_name}.")
+            source_rows_by_layer[layer_name] = source_rows
+            if info.geom_column:
+                spatial_layers.append(layer_name)
+        build_spatial_indexes(gpkg_path, spatial_layers)
+    finally:
+        gdal.SetConfigOption("OGR_SQLITE_SYNCHRONOUS", None)
+        gdal.SetConfigOption("OGR_SQLITE_CACHE", None)
+    summary, integrity_ok = gpkg_integrity_summary(gpkg_path, source_rows_by_layer)
+    return results, summary, integrity_ok
+
+MANIFEST_NAME = "backup_manifest.json"
+CHANGE_COUNTERS = ("n_tup_ins", "n_tup_upd", "n_tup_del", "n_live_tup")
+
+def get_change_markers(cur):
+    """Compteurs d'activité de chaque table (pg_stat_user_tables), en une seule requête.
+
+    Les insertions, mises à jour et suppressions ne font que croître ; n_live_tup
+    couvre les TRUNCATE, que n_tup_del ne compte pas.
+    """
+    cur.execute(f"""
+        SELECT schemaname, relname, {", ".join(CHANGE_COUNTERS)}
+        FROM pg_stat_user_tables;
+    """)
+    return {(row[0], row[1]): dict(zip(CHANGE_COUNTERS, row[2:])) for row in cur.fetchall()}
+
+def get_table_checksum(cur, schema, table_name):
+    """Nombre de lignes et somme de contrôle du contenu d'une table.
+
+    La somme des empreintes md5 des lignes ne dépend pas de l'ordre de lecture :
+    pas de tri, un seul parcours séquentiel de la table.
+    """
+    cur.execute(f"""
+        SELECT count(*), coalesce(sum(('x' || substr(md5(t::text), 1, 15))::bit(60)::bigint), 0)
+        FROM {quote_ident(schema)}.{quote_ident(table_name)} t;
+    """)
+    row_count, checksum = cur.fetchone()
+    return {"lignes": row_count, "somme_controle": str(checksum)}
+
+def load_manifest(output_folder):
+    path = os.path.join(output_folder, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f).get("tables", {})
+    except (OSError, ValueError) as e:
+        print(f"[ERREUR] Manifeste illisible, export complet : {e}")
+        return {}
+
+def save_manifest(output_folder, entries):
+    path = os.path.join(output_folder, MANIFEST_NAME)
+    manifest = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "tables": entries,
+    }
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+    print(f"[LOG] Manifeste écrit : {path}")
+
+def plan_incremental(cur, selected, catalog, output_folder, manifest, use_checksums=False,
+                     single_file=None):
+    """Sépare les tables à réexporter des tables inchangées depuis la dernière sauvegarde.
+
+    Une table est inchangée si son fichier existe encore et que ses compteurs (et, avec
+    `use_checksums`, sa somme de contrôle) sont ceux du manifeste. Les marqueurs sont
+    relevés avant l'export : une modification faite pendant l'export sera vue au
+    prochain passage. Avec `single_file`, toutes les tables sont dans ce GeoPackage.
+    Sur un serveur en réplication (hot standby), pg_stat_user_tables ne compte pas les
+    écritures rejouées : la somme de contrôle est alors toujours utilisée.
+    Retourne (tables à exporter, tables inchangées, marqueurs par table).
+    """
+    cur.execute("SELECT pg_is_in_recovery();")
+    if cur.fetchone()[0] and not use_checksums:
+        print("[LOG] Serveur en réplication : compteurs d'activité non fiables, "
+              "comparaison par somme de contrôle")
+        use_checksums = True
+    counters = get_change_markers(cur)
+    to_export, unchanged, markers = [], [], {}
+    for schema, table_name in selected:
+        key = f"{schema}.{table_name}"
+        geom_column = catalog[(schema, table_name)].geom_column
+        out_path = single_file or table_output_path(output_folder, schema, table_name, geom_column)
+        marker = {
+            "fichier": os.path.basename(out_path),
+            "cle_primaire": list(catalog[(schema, table_name)].primary_key),
+            "compteurs": counters.get((schema, table_name)),
+        }
+        previous = manifest.get(key)
+        same = (
+            previous is not None
+            and marker["compteurs"] is not None
+            and os.path.exists(out_path)
+            and not os.path.exists(checkpoint_path(out_path, f"{schema}_{table_name}"))
+            and previous.get("fichier") == marker["fichier"]
+            and previous.get("compteurs") == marker["compteurs"]
+        )
+        if use_checksums and (same or previous is None or "somme_controle" not in previous):
+            # La somme de contrôle confirme les tables en apparence inchangées (DDL,
+            # statistiques réinitialisées) ; elle n'est pas calculée pour les tables modifiées.
+            marker.update(get_table_checksum(cur, schema, table_name))
+            same = same and previous.get("somme_controle") == marker["somme_controle"]
+        markers[key] = marker
+        if same:
+            unchanged.append((schema, table_name))
+        else:
+            to_export.append((schema, table_name))
+    print(f"[LOG] Incrémental : {len(to_export)} tables à exporter, {len(unchanged)} inchangées")
+    return to_export, unchanged, markers
+
+def select_tables(tables_by_schema, include=("*",), exclude=()):
+    """Tables « schéma.table » retenues par les motifs fnmatch d'inclusion et d'exclusion."""
+    selected = []
+    for schema, tables in tables_by_schema.items():
+        for table_name in tables:
+            name = f"{schema}.{table_name}"
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in include) and \
+                    not any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude):
+                selected.append((schema, table_name))
+    return selected
+
+def run_backup(cur, params, selected, catalog, output_folder, workers=1, chunk_rows=0,
+               single_file=False, incremental=False, use_checksums=False, progress=None):
+    """Enchaîne plan incrémental, export, mise à jour du manifeste et rapport d'exécution.
+
+    `progress(terminées, prévues)` est appelé après chaque table exportée. Retourne un
+    dictionnaire : tables à exporter, tables inchangées, résultats par table (None ou
+    message d'erreur), erreurs, résumé et état d'intégrité du GeoPackage commun le cas
+    échéant, totaux et chemin du rapport JSON (rapport_sauvegarde_<date>.json).
+    """
+    gpkg_path = os.path.join(output_folder, f"{params.get('dbname') or params['service']}.gpkg") if single_file else None
+
+    to_export, unchanged, manifest = selected, [], None
+    if incremental:
+        manifest = load_manifest(output_folder)
+        to_export, unchanged, markers = plan_incremental(
+            cur, selected, catalog, output_folder, manifest,
+            use_checksums=use_checksums, single_file=gpkg_path
+        )
+
+    report = RunReport(len(to_export), progress)
+    summary, integrity_ok = [], True
+    if gpkg_path:
+        results, summary, integrity_ok = export_tables_gpkg(
+            params, to_export, catalog, gpkg_path, chunk_rows=chunk_rows, report=report
+        )
+    else:
+        results = export_tables(
+            params, to_export, catalog, output_folder, workers=workers, chunk_rows=chunk_rows, report=report
+        )
+
+    if incremental:
+        # Seules les tables exportées avec succès prennent leurs nouveaux marqueurs ;
+        # une table en échec garde son ancienne entrée et sera retentée.
+        for schema, table_name in selected:
+            key = f"{schema}.{table_name}"
+            if (schema, table_name) in unchanged or results.get((schema, table_name), "") is None:
+                manifest[key] = markers[key]
+    else:
+        # Sans compteurs, l'entrée sert à la restauration (table cible et clé primaire
+        # d'origine) ; une prochaine sauvegarde incrémentale réexportera la table.
+        manifest = load_manifest(output_folder)
+        for (schema, table_name), error in results.items():
+            if error is None:
+                info = catalog[(schema, table_name)]
+                out_path = gpkg_path or table_output_path(output_folder, schema, table_name, info.geom_column)
+                manifest[f"{schema}.{table_name}"] = {
+                    "fichier": os.path.basename(out_path),
+                    "cle_primaire": list(info.primary_key),
+                }
+    save_manifest(output_folder, manifest)
+
+    report_path = os.path.join(output_folder, f"rapport_sauvegarde_{report.started:%Y%m%d_%H%M%S}.json")
+    run_report = report.write(
+        report_path,
+        base=params.get("dbname") or params.get("service"),
+        dossier=output_folder,
+        geopackage_unique=gpkg_path,
+        exports_simultanes=1 if gpkg_path else workers,
+        morceaux=chunk_rows,
+        incrementale=incremental,
+        inchangees=[f"{schema}.{table_name}" for schema, table_name in unchanged],
+        integrite=summary,
+    )
+
+    return {
+        "to_export": to_export,
+        "unchanged": unchanged,
+        "results": results,
+        "errors": [error for error in results.values() if error],
+        "gpkg_path": gpkg_path,
+        "summary": summary,
+        "integrity_ok": integrity_ok,
+        "totals": run_report["totaux"],
+        "report_path": report_path,
+    }
@@ -1,15 +1,52 @@
-from qgis.core import (
-    QgsDataSourceUri,
-    QgsVectorLayer,
-    QgsVectorFileWriter
-)
-from qgis.PyQt.QtCore import Qt
+from qgis.core import QgsApplication, QgsTask
+from qgis.PyQt.QtCore import Qt, QAbstractItemModel, QModelIndex, QSortFilterProxyModel, QTimer
 from qgis.PyQt.QtWidgets import (
-    QFileDialog, QMessageBox, QDialog, QVBoxLayout, QTreeWidget, QTreeWidgetItem, QPushButton,
-    QLabel, QLineEdit, QFormLayout, QHBoxLayout
+    QFileDialog, QMessageBox, QDialog, QVBoxLayout, QTreeView, QPushButton,
+    QLabel, QLineEdit, QFormLayout, QHBoxLayout, QSpinBox, QCheckBox
 )
+import inspect
 import os
-import psycopg2
+import sys
+
+def _script_folders():
+    """Dossiers où chercher backup_postgres_core.py.
+
+    La console QGIS exécute le fichier par exec(), sans __file__ : on se rabat sur le
+    fichier source de cette fonction puis sur les dossiers de scripts de Processing.
+    """
+    try:
+        return [os.path.dirname(os.path.abspath(__file__))]
+    except NameError:
+        source = inspect.getsourcefile(_script_folders)
+        folders = [os.path.dirname(os.path.abspath(source))] if source and os.path.exists(source) else []
+        try:
+            from processing.script import ScriptUtils
+            folders += ScriptUtils.scriptsFolders()
+        except ImportError:
+            pass
+        return folders
+
+for _folder in _script_folders():
+    if os.path.exists(os.path.join(_folder, "backup_postgres_core.py")):
+        if _folder not in sys.path:
+            sys.path.insert(0, _folder)
+        break
+
+try:
+    from backup_postgres_core import (
+        CHUNK_ROWS,
+        catalog_tables_by_schema,
+        connect_pg,
+        get_catalog,
+        run_backup
+    )
+except ModuleNotFoundError as error:
+    if error.name != "backup_postgres_core":
+        raise
+    raise RuntimeError(
+        "backup_postgres_core.py introuvable : ajouter à sys.path le dossier qui contient "
+        "backup_postgres_db.py et backup_postgres_core.py"
+    )
 
 def show_error(msg, parent=None):
     QMessageBox.critical(parent, "Erreur", msg)
@@ -59,13 +96,7 @@ class ConnexionDialog(QDialog):
 def get_pg_connection(params, parent=None):
     try:
         print(f"[LOG] Connexion à la base {params['dbname']} sur {params['host']}:{params['port']} avec l'utilisateur {params['user']}")
-        conn = psycopg2.connect(
-            host=params["host"],
-            port=params["port"],
-            dbname=params["dbname"],
-            user=params["user"],
-            password=params["password"]
-        )
+        conn = connect_pg(params)
         print("[LOG] Connexion réussie.")
         return conn
     except Exception as e:
@@ -73,29 +104,195 @@ def get_pg_connection(params, parent=None):
         print(f"[ERREUR] Exception lors de la connexion : {e}")
         return None
 
-def get_all_tables_by_schema(cur):
-    cur.execute("""
-        SELECT table_schema, table_name
-        FROM information_schema.tables
-        WHERE table_type = 'BASE TABLE'
-        AND table_schema NOT IN ('pg_catalog', 'information_schema', 'topology')
-        AND table_schema NOT LIKE 'pg_toast%'
-        ORDER BY table_schema, table_name;
-    """)
-    tables_by_schema = {}
-    for schema, table in cur.fetchall():
-        tables_by_schema.setdefault(schema, []).append(table)
-    print(f"[LOG] Tables trouvées par schéma : { {k: len(v) for k,v in tables_by_schema.items()} }")
-    return tables_by_schema
-
-def get_geom_columns_by_schema_table(cur):
-    cur.execute("SELECT f_table_schema, f_table_name, f_geometry_column FROM geometry_columns;")
-    result = {(row[0], row[1]): row[2] for row in cur.fetchall()}
-    print(f"[LOG] Tables spatiales trouvées : {len(result)}")
-    return result
+
+def format_size(size):
+    for unit in ("o", "Ko", "Mo", "Go"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} To"
+
+FILTER_DELAY_MS = 250
+AUTO_EXPAND_SCHEMAS = 20
+
+class _SchemaNode:
+    __slots__ = ("row", "name", "tables", "lower_names", "loaded", "size", "row_estimate")
+
+    def __init__(self, row, name, tables, catalog):
+        self.row = row
+        self.name = name
+        self.tables = tables
+        self.lower_names = [table.lower() for table in tables]
+        self.loaded = False
+        self.size = sum(catalog[(name, table)].size or 0 for table in tables)
+        self.row_estimate = sum(catalog[(name, table)].row_estimate or 0 for table in tables)
+
+class TableCatalogModel(QAbstractItemModel):
+    """Schémas et tables du catalogue ; les tables d'un schéma sont chargées à son ouverture.
+
+    Les cases cochées sont gardées dans `checked` (ensemble de (schéma, table)) et non
+    dans des éléments graphiques : elles survivent au filtrage et au tri.
+    """
+    HEADERS = ["Schéma", "Table", "Taille", "Lignes (est.)"]
+
+    def __init__(self, catalog, parent=None):
+        super().__init__(parent)
+        self.catalog = catalog
+        self.schemas = [
+            _SchemaNode(row, schema, tables, catalog)
+            for row, (schema, tables) in enumerate(sorted(catalog_tables_by_schema(catalog).items()))
+        ]
+        self.checked = set()
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column)
+        return self.createIndex(row, column, self.schemas[parent.row()])
+
+    def parent(self, index):
+        node = index.internalPointer() if index.isValid() else None
+        if node is None:
+            return QModelIndex()
+        return self.createIndex(node.row, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.schemas)
+        if parent.internalPointer() is None and parent.column() == 0:
+            node = self.schemas[parent.row()]
+            return len(node.tables) if node.loaded else 0
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.HEADERS)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return bool(self.schemas)
+        return parent.internalPointer() is None and parent.column() == 0 and bool(self.schemas[parent.row()].tables)
+
+    def canFetchMore(self, parent):
+        return parent.isValid() and parent.internalPointer() is None and not self.schemas[parent.row()].loaded
+
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        node = self.schemas[parent.row()]
+        self.beginInsertRows(parent, 0, len(node.tables) - 1)
+        node.loaded = True
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == 0:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def _schema_check_state(self, node):
+        checked = sum((node.name, table) in self.checked for table in node.tables)
+        if checked == 0:
+            return Qt.Unchecked
+        return Qt.Checked if checked == len(node.tables) else Qt.PartiallyChecked
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node, column = index.internalPointer(), index.column()
+        if node is None:
+            schema = self.schemas[index.row()]
+            if role == Qt.CheckStateRole and column == 0:
+                return self._schema_check_state(schema)
+            values = (schema.name, f"{len(schema.tables)} tables", schema.size, schema.row_estimate)
+        else:
+            table = node.tables[index.row()]
+            info = self.catalog[(node.name, table)]
+            if role == Qt.CheckStateRole and column == 0:
+                return Qt.Checked if (node.name, table) in self.checked else Qt.Unchecked
+            values = (node.name, ("🌐 " if info.geom_column else "") + table, info.size, info.row_estimate)
+        if role == Qt.DisplayRole:
+            if column == 2:
+                return format_size(values[2] or 0)
+            if column == 3:
+                return f"{values[3]:,}".replace(",", " ") if values[3] is not None else "?"
+            return values[column]
+        if role == Qt.UserRole:  # clé de tri
+            return values[column] if values[column] is not None else -1
+        if role == Qt.TextAlignmentRole and column >= 2:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.CheckStateRole or index.column() != 0:
+            return False
+        node = index.internalPointer()
+        if node is None:
+            return self.set_schema_tables_checked(index, self.schemas[index.row()].tables, value == Qt.Checked)
+        table = (node.name, node.tables[index.row()])
+        if value == Qt.Checked:
+            self.checked.add(table)
+        else:
+            self.checked.discard(table)
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        parent = self.parent(index)
+        self.dataChanged.emit(parent, parent, [Qt.CheckStateRole])
+        return True
+
+    def set_schema_tables_checked(self, index, tables, checked):
+        """Coche ou décoche `tables` du schéma d'index `index`."""
+        schema = self.schemas[index.row()]
+        tables = {(schema.name, table) for table in tables}
+        if checked:
+            self.checked |= tables
+        else:
+            self.checked -= tables
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        if schema.loaded and schema.tables:
+            self.dataChanged.emit(self.index(0, 0, index), self.index(len(schema.tables) - 1, 0, index),
+                                  [Qt.CheckStateRole])
+        return True
+
+class TableFilterProxyModel(QSortFilterProxyModel):
+    """Masque les tables dont le nom ne contient pas le texte du filtre, sans recréer d'éléments.
+
+    Un schéma reste visible si l'une de ses tables correspond, même si elles ne sont
+    pas encore chargées.
+    """
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.filter_text = ""
+
+    def set_filter_text(self, text):
+        self.filter_text = text.lower()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if not self.filter_text:
+            return True
+        model = self.sourceModel()
+        if not source_parent.isValid():
+            return any(self.filter_text in name for name in model.schemas[source_row].lower_names)
+        return self.filter_text in model.schemas[source_parent.row()].lower_names[source_row]
+
+    def setData(self, index, value, role=Qt.EditRole):
+        source = self.mapToSource(index)
+        if role == Qt.CheckStateRole and self.filter_text and source.isValid() and source.internalPointer() is None:
+            # Cocher un schéma filtré ne coche que ses tables visibles
+            schema = self.sourceModel().schemas[source.row()]
+            visible = [table for table, name in zip(schema.tables, schema.lower_names) if self.filter_text in name]
+            return self.sourceModel().set_schema_tables_checked(source, visible, value == Qt.Checked)
+        return super().setData(index, value, role)
 
 class TableTreeSelectionDialog(QDialog):
-    def __init__(self, tables_by_schema, spatial_tables_set, parent=None):
+    def __init__(self, catalog, parent=None):
         super().__init__(parent)
         self.setWindowTitle("Sélectionner les tables à exporter")
         layout = QVBoxLayout()
@@ -105,71 +302,123 @@ class TableTreeSelectionDialog(QDialog):
         self.filter_edit.setPlaceholderText("Filtrer les tables par nom...")
         layout.addWidget(self.filter_edit)
 
-        self.tree = QTreeWidget()
-        self.tree.setHeaderLabels(["Schéma", "Table"])
-        self.tree.setSelectionMode(QTreeWidget.MultiSelection)
+        self.model = TableCatalogModel(catalog, self)
+        self.proxy = TableFilterProxyModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.proxy.setSortRole(Qt.UserRole)
+        self.tree = QTreeView()
+        self.tree.setModel(self.proxy)
+        self.tree.setUniformRowHeights(True)
+        self.tree.setSortingEnabled(True)
+        self.tree.sortByColumn(0, Qt.AscendingOrder)
+        self.tree.setColumnWidth(0, 200)
+        self.tree.setColumnWidth(1, 250)
         layout.addWidget(self.tree)
+
+        workers_layout = QHBoxLayout()
+        workers_layout.addWidget(QLabel("Exports simultanés :"))
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, 32)
+        self.workers_spin.setValue(min(4, os.cpu_count() or 1))
+        workers_layout.addWidget(self.workers_spin)
+        layout.addLayout(workers_layout)
+
+        chunk_layout = QHBoxLayout()
+        chunk_layout.addWidget(QLabel("Export par morceaux (lignes, 0 = d'un bloc) :"))
+        self.chunk_spin = QSpinBox()
+        self.chunk_spin.setRange(0, 10000000)
+        self.chunk_spin.setSingleStep(10000)
+        self.chunk_spin.setValue(CHUNK_ROWS)
+        chunk_layout.addWidget(self.chunk_spin)
+        layout.addLayout(chunk_layout)
+
+        self.single_file_check = QCheckBox("Un seul GeoPackage pour toutes les tables")
+        layout.addWidget(self.single_file_check)
+
+        self.incremental_check = QCheckBox("Sauvegarde incrémentale (ignorer les tables inchangées)")
+        layout.addWidget(self.incremental_check)
+        self.checksum_check = QCheckBox("Confirmer par somme de contrôle (lecture complète des tables)")
+        self.checksum_check.setEnabled(False)
+        self.incremental_check.toggled.connect(self.checksum_check.setEnabled)
+        layout.addWidget(self.checksum_check)
+
+        self.background_check = QCheckBox("Exécuter en tâche de fond (progression dans la barre d'état)")
+        self.background_check.setChecked(True)
+        layout.addWidget(self.background_check)
+
         btn = QPushButton("Exporter")
         btn.clicked.connect(self.accept)
         layout.addWidget(btn)
         self.setLayout(layout)
 
-        self.tables_by_schema = tables_by_schema
-        self.spatial_tables_set = spatial_tables_set
-        self.populate_tree()
-
-        self.filter_edit.textChanged.connect(self.populate_tree)
-
-    def populate_tree(self):
-        self.tree.clear()
-        filter_text = self.filter_edit.text().lower()
-        for schema, tables in sorted(self.tables_by_schema.items()):
-            schema_item = QTreeWidgetItem([schema])
-            schema_item.setFlags(schema_item.flags() & ~Qt.ItemIsSelectable)
-            added = False
-            for table in tables:
-                if filter_text and filter_text not in table.lower():
-                    continue
-                table_item = QTreeWidgetItem([schema, table])
-                table_item.setFlags(table_item.flags() | Qt.ItemIsUserCheckable)
-                table_item.setCheckState(0, Qt.Unchecked)
-                if (schema, table) in self.spatial_tables_set:
-                    table_item.setText(1, "🌐 " + table)
-                schema_item.addChild(table_item)
-                added = True
-            if added:
-                self.tree.addTopLevelItem(schema_item)
-        self.tree.expandAll()
+        # Le filtre n'est appliqué qu'une fois la frappe arrêtée
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DELAY_MS)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.filter_edit.textChanged.connect(self.filter_timer.start)
+
+    def apply_filter(self):
+        self.proxy.set_filter_text(self.filter_edit.text())
+        if self.filter_edit.text() and self.proxy.rowCount() <= AUTO_EXPAND_SCHEMAS:
+            for row in range(self.proxy.rowCount()):
+                self.tree.expand(self.proxy.index(row, 0))
 
     def selected_tables(self):
-        result = []
-        root = self.tree.invisibleRootItem()
-        for i in range(root.childCount()):
-            schema_item = root.child(i)
-            schema = schema_item.text(0)
-            for j in range(schema_item.childCount()):
-                table_item = schema_item.child(j)
-                if table_item.checkState(0) == Qt.Checked:
-                    table = table_item.text(1)
-                    table = table.replace("🌐 ", "")
-                    result.append((schema, table))
-        return result
-
-def is_export_successful(err, out_path):
-    """Compatibilité PyQGIS: considère l'export comme réussi si 'err' vaut 0 ou (0, '') OU si le fichier est bien créé."""
-    # QgsVectorFileWriter.NoError = 0
-    if isinstance(err, tuple):
-        code = err[0] if len(err) > 0 else 99
-        # SQLite non spatial: (0, '') mais parfois aussi (0, None)
-        if code == 0:
-            return True
-    elif isinstance(err, int):
-        if err == 0:
+        return sorted(self.model.checked)
+
+def backup_message(run):
+    errors = run["errors"]
+    totals = run["totals"]
+    msg = f"{len(run['results']) - len(errors)}/{len(run['to_export'])} tables exportées."
+    if run["unchanged"]:
+        msg += f"\n{len(run['unchanged'])} tables inchangées ignorées."
+    msg += (f"\n{totals['lignes']} lignes, {totals['octets'] / 1e6:.1f} Mo en {totals['duree_s']:.0f} s "
+            f"({totals['lignes_s'] or 0} lignes/s).\nRapport : {run['report_path']}")
+    if run["summary"]:
+        msg += "\n\nIntégrité de " + os.path.basename(run["gpkg_path"]) + " :\n- " + "\n- ".join(run["summary"])
+    if errors:
+        msg += "\n\nProblèmes rencontrés :\n- " + "\n- ".join(errors)
+    return msg
+
+class BackupTask(QgsTask):
+    """Sauvegarde exécutée par le gestionnaire de tâches de QGIS, avec barre de progression."""
+
+    def __init__(self, conn, params, selected, catalog, output_folder, options, parent=None):
+        super().__init__(f"Sauvegarde de {params['dbname']}", QgsTask.Flags())
+        self.conn = conn
+        self.params = params
+        self.selected = selected
+        self.catalog = catalog
+        self.output_folder = output_folder
+        self.options = options
+        self.parent = parent
+        self.run_result = None
+        self.exception = None
+
+    def run(self):
+        try:
+            self.run_result = run_backup(
+                self.conn.cursor(), self.params, self.selected, self.catalog, self.output_folder,
+                progress=lambda done, total: self.setProgress(100 * done / max(total, 1)),
+                **self.options
+            )
             return True
-    # Parfois QGIS retourne une erreur mais le fichier est bien créé !
-    if os.path.exists(out_path):
-        return True
-    return False
+        except Exception as e:
+            self.exception = e
+            return False
+
+    def finished(self, result):
+        self.conn.close()
+        _backup_tasks.remove(self)
+        if result:
+            show_info(backup_message(self.run_result), self.parent)
+        else:
+            show_error(f"Erreur inattendue :\n{self.exception}", self.parent)
+            print(f"[EXCEPTION] Générale : {self.exception}")
+
+# Références aux tâches en cours (sinon le ramasse-miettes les détruit)
+_backup_tasks = []
 
 def main(parent=None):
     conn_dialog = ConnexionDialog(parent)
@@ -184,15 +433,12 @@ def main(parent=None):
 
     try:
         cur = conn.cursor()
-        tables_by_schema = get_all_tables_by_schema(cur)
-        if not tables_by_schema:
+        catalog = get_catalog(cur, params)
+        if not catalog:
             show_error("Aucune table trouvée dans la base.", parent)
             return
 
-        geom_col_by_schema_table = get_geom_columns_by_schema_table(cur)
-        spatial_tables_set = set(geom_col_by_schema_table.keys())
-
-        table_dialog = TableTreeSelectionDialog(tables_by_schema, spatial_tables_set, parent)
+        table_dialog = TableTreeSelectionDialog(catalog, parent)
         if table_dialog.exec_() != QDialog.Accepted:
             show_info("Export annulé.", parent)
             return
@@ -208,51 +454,23 @@ def main(parent=None):
             show_info("Aucun dossier sélectionné.", parent)
             return
 
-        uri = QgsDataSourceUri()
-        uri.setConnection(
-            params["host"],
-            params["port"],
-            params["dbname"],
-            params["user"],
-            params["password"]
-        )
-        exported = 0
-        errors = []
-
-        for schema, table_name in selected:
-            try:
-                geom_column = geom_col_by_schema_table.get((schema, table_name))
-                if geom_column:
-                    uri.setDataSource(schema, table_name, geom_column)
-                    layer = QgsVectorLayer(uri.uri(), f"{schema}.{table_name}", "postgres")
-                    out_path = os.path.join(output_folder, f"{schema}_{table_name}.gpkg")
-                    export_format = "GPKG"
-                else:
-                    uri.setDataSource(schema, table_name, None)
-                    layer = QgsVectorLayer(uri.uri(), f"{schema}.{table_name}", "postgres")
-                    out_path = os.path.join(output_folder, f"{schema}_{table_name}.sqlite")
-                    export_format = "SQLite"
-
-                print(f"[LOG] Export de {schema}.{table_name} vers {out_path} (format {export_format})")
-                if layer.isValid():
-                    err = QgsVectorFileWriter.writeAsVectorFormat(layer, out_path, "UTF-8", layer.crs(), export_format)
-                    if is_export_successful(err, out_path):
-                        exported += 1
-                        print(f"[SUCCES] {schema}.{table_name} exportée en {export_format}.")
-                    else:
-                        errors.append(f"Erreur d'export pour {schema}.{table_name} ({export_format}) : {err}")
-                        print(f"[ERREUR] Export {schema}.{table_name} ({export_format}) : code {err}")
-                else:
-                    errors.append(f"Invalide ou inaccessible : {schema}.{table_name}")
-                    print(f"[ERREUR] Couche invalide ou inaccessible : {schema}.{table_name}")
-            except Exception as e:
-                errors.append(f"Erreur pour {schema}.{table_name} : {e}")
-                print(f"[EXCEPTION] {schema}.{table_name} - {e}")
-
-        msg = f"{exported}/{len(selected)} tables exportées."
-        if errors:
-            msg += "\n\nProblèmes rencontrés :\n- " + "\n- ".join(errors)
-        show_info(msg, parent)
+        options = {
+            "workers": table_dialog.workers_spin.value(),
+            "chunk_rows": table_dialog.chunk_spin.value(),
+            "single_file": table_dialog.single_file_check.isChecked(),
+            "incremental": table_dialog.incremental_check.isChecked(),
+            "use_checksums": table_dialog.checksum_check.isChecked(),
+        }
+        if table_dialog.background_check.isChecked():
+            # La tâche garde la connexion et la ferme à la fin de la sauvegarde
+            task = BackupTask(conn, params, selected, catalog, output_folder, options, parent)
+            _backup_tasks.append(task)
+            QgsApplication.taskManager().addTask(task)
+            conn = None
+            return
+
+        run = run_backup(cur, params, selected, catalog, output_folder, **options)
+        show_info(backup_message(run), parent)
     except Exception as e:
         show_error(f"Erreur inattendue :\n{e}", parent)
         print(f"[EXCEPTION] Générale : {e}")
@@ -261,11 +479,13 @@ def main(parent=None):
             cur.close()
         except Exception:
             pass
-        conn.close()
+        if conn is not None:
+            conn.close()
 
-# Pour QGIS, utilisez iface.mainWindow() comme parent
-try:
-    main(parent=iface.mainWindow())
-except Exception as e:
-    print(f"[EXCEPTION] Fatale : {e}")
-    QMessageBox.critical(iface.mainWindow(), "Erreur fatale", str(e))
+# Pour QGIS, utilisez iface.mainWindow() comme parent ; hors de QGIS, voir backup_postgres_headless.py
+if "iface" in globals():
+    try:
+        main(parent=iface.mainWindow())
+    except Exception as e:
+        print(f"[EXCEPTION] Fatale : {e}")
+        QMessageBox.critical(iface.mainWindow(), "Erreur fatale", str(e))
@@ -0,0 +1,162 @@
+"""Sauvegarde PostgreSQL/PostGIS planifiée, sans interface graphique.
+
+Même export que backup_postgres_db.py, piloté par un fichier de configuration :
+
+    python backup_postgres_headless.py sauvegarde.ini
+
+    [connexion]
+    # soit un service de pg_service.conf...
+    service = sig
+    # ...soit les paramètres (mot de passe vide : PGPASSWORD ou ~/.pgpass)
+    host = serveur
+    port = 5432
+    dbname = sig
+    user = sauvegarde
+    password =
+
+    [tables]
+    # motifs « schéma.table » séparés par des virgules ou des retours à la ligne
+    inclure = public.*, inventaire.*
+    exclure = *.tmp_*
+
+    [sortie]
+    dossier = /srv/sauvegardes/sig
+    geopackage_unique = non
+    incremental = oui
+    sommes_controle = non
+
+    [export]
+    exports_simultanes = 4
+    morceaux = 100000
+
+Codes de sortie : 0 succès, 1 tables en erreur ou intégrité en défaut,
+2 configuration invalide, 3 connexion impossible.
+"""
+import configparser
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from qgis.core import QgsApplication
+
+from backup_postgres_core import (
+    CHUNK_ROWS,
+    catalog_tables_by_schema,
+    connect_pg,
+    get_catalog,
+    run_backup,
+    select_tables
+)
+
+EXIT_OK = 0
+EXIT_EXPORT_ERRORS = 1
+EXIT_CONFIG = 2
+EXIT_CONNECTION = 3
+
+def _patterns(value):
+    return [pattern.strip() for pattern in value.replace("\n", ",").split(",") if pattern.strip()]
+
+def read_config(path):
+    """Lit le fichier de configuration ; lève ValueError s'il est incomplet."""
+    config = configparser.ConfigParser()
+    config.BOOLEAN_STATES = dict(configparser.ConfigParser.BOOLEAN_STATES, oui=True, non=False)
+    if not config.read(path, encoding="utf-8"):
+        raise ValueError(f"fichier de configuration introuvable : {path}")
+
+    connexion = config["connexion"] if config.has_section("connexion") else {}
+    if connexion.get("service"):
+        params = {key: connexion.get(key, "") for key in ("service", "dbname", "user", "password")}
+    else:
+        missing = [key for key in ("host", "dbname", "user") if not connexion.get(key)]
+        if missing:
+            raise ValueError(f"[connexion] : paramètres manquants : {', '.join(missing)} (ou service)")
+        params = {
+            "host": connexion["host"],
+            "port": connexion.get("port", "5432"),
+            "dbname": connexion["dbname"],
+            "user": connexion["user"],
+            "password": connexion.get("password", ""),
+        }
+
+    output_folder = config.get("sortie", "dossier", fallback="")
+    if not output_folder:
+        raise ValueError("[sortie] : le dossier de sortie est obligatoire")
+
+    return {
+        "params": params,
+        "include": _patterns(config.get("tables", "inclure", fallback="*")),
+        "exclude": _patterns(config.get("tables", "exclure", fallback="")),
+        "output_folder": output_folder,
+        "single_file": config.getboolean("sortie", "geopackage_unique", fallback=False),
+        "incremental": config.getboolean("sortie", "incremental", fallback=False),
+        "use_checksums": config.getboolean("sortie", "sommes_controle", fallback=False),
+        "workers": config.getint("export", "exports_simultanes", fallback=min(4, os.cpu_count() or 1)),
+        "chunk_rows": config.getint("export", "morceaux", fallback=CHUNK_ROWS),
+    }
+
+def run(settings):
+    params = settings["params"]
+    try:
+        conn = connect_pg(params)
+    except Exception as e:
+        print(f"[ERREUR] Connexion échouée : {e}")
+        return EXIT_CONNECTION
+
+    start = time.perf_counter()
+    try:
+        cur = conn.cursor()
+        catalog = get_catalog(cur, params)
+        selected = select_tables(catalog_tables_by_schema(catalog), settings["include"], settings["exclude"])
+        if not selected:
+            print("[ERREUR] Aucune table ne correspond aux motifs d'inclusion et d'exclusion.")
+            return EXIT_CONFIG
+        print(f"[LOG] {len(selected)} tables retenues")
+        os.makedirs(settings["output_folder"], exist_ok=True)
+        result = run_backup(
+            cur, params, selected, catalog, settings["output_folder"],
+            workers=settings["workers"],
+            chunk_rows=settings["chunk_rows"],
+            single_file=settings["single_file"],
+            incremental=settings["incremental"],
+            use_checksums=settings["use_checksums"]
+        )
+    finally:
+        conn.close()
+
+    errors = result["errors"]
+    totals = result["totals"]
+    print(f"[LOG] {len(result['results']) - len(errors)}/{len(result['to_export'])} tables exportées, "
+          f"{len(result['unchanged'])} inchangées, en {time.perf_counter() - start:.0f} s "
+          f"({totals['lignes']} lignes, {totals['lignes_s'] or 0} lignes/s) ; rapport : {result['report_path']}")
+    for error in errors:
+        print(f"[ERREUR] {error}")
+    if errors or not result["integrity_ok"]:
+        return EXIT_EXPORT_ERRORS
+    print("[SUCCES] Sauvegarde terminée.")
+    return EXIT_OK
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print(__doc__)
+        return EXIT_CONFIG
+    try:
+        settings = read_config(argv[0])
+    except (ValueError, configparser.Error) as e:
+        print(f"[ERREUR] Configuration : {e}")
+        return EXIT_CONFIG
+
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    try:
+        return run(settings)
+    except Exception as e:
+        print(f"[EXCEPTION] Fatale : {e}")
+        return EXIT_EXPORT_ERRORS
+    finally:
+        qgs.exitQgis()
+
+if __name__ == "__main__":
+    sys.exit(main())
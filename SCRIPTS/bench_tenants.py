@@ -0,0 +1,312 @@
+"""Banc d'essai de tenants.py, sans interface graphique.
+
+Génère des blocs de récolte synthétiques (densité et regroupement réglables) et
+mesure, pour chaque taille et chaque mode du moteur, le temps écoulé, la mémoire
+résidente maximale et le nombre d'appels GEOS distance(). Les blocs sont générés
+une fois par taille dans un processus à part ; chaque cas tourne dans un nouveau
+processus qui les recharge, pour que la mémoire maximale lui soit propre. Le pic
+après chargement des données, le pic du processus en fin de calcul et le pic du
+plus gros processus de travail sont donnés séparément. Les résultats sont écrits
+dans un fichier JSON pour comparer les commits entre eux.
+
+    python bench_tenants.py --blocs 1000 10000 100000 500000 --json resultats.json
+    python bench_tenants.py --blocs 10000 --modes naif index --densite 0.5
+    python bench_tenants.py --blocs 100000 --modes index parallele --processus 2 4 8
+    python bench_tenants.py --blocs 10000 --modes postgis --postgres "service=sig"
+
+Modes : naif (ancienne double boucle, limité par --naif-max), index (index
+spatial + union-find), parallele (calcul par tuiles), postgis (ST_ClusterDBSCAN
+dans la base désignée par --postgres ; les appels GEOS y sont faits par le serveur).
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import os
+import pickle
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from qgis.core import (
+    Qgis, QgsApplication, QgsCoordinateReferenceSystem, QgsDataSourceUri, QgsFeature, QgsField, QgsFields,
+    QgsGeometry, QgsPointXY, QgsVectorLayer, QgsVectorLayerExporter
+)
+from PyQt5.QtCore import QVariant
+
+from tenants import assign_tenants, cluster_tenants, postgis_tenants, read_blocs
+
+MODES = ["naif", "index", "parallele", "postgis"]
+BENCH_TABLE = "bench_tenants_blocs"
+
+
+def synthetic_blocks(count, density=0.3, clustering=0.5, size=150.0, seed=0):
+    """Génère `count` polygones irréguliers d'environ `size` mètres.
+
+    `density` est la part approximative du territoire couverte par les blocs ;
+    `clustering` est la part des blocs groupés autour de chantiers plutôt que
+    répartis uniformément.
+    """
+    rng = random.Random(seed)
+    spacing = size / math.sqrt(density)
+    side = spacing * math.sqrt(count)
+    hotspots = [(rng.uniform(0, side), rng.uniform(0, side)) for _ in range(max(1, count // 200))]
+    fields = QgsFields()
+    fields.append(QgsField('nom', QVariant.String))
+    features = []
+    for i in range(count):
+        if rng.random() < clustering:
+            hx, hy = rng.choice(hotspots)
+            cx, cy = rng.gauss(hx, spacing * 3), rng.gauss(hy, spacing * 3)
+        else:
+            cx, cy = rng.uniform(0, side), rng.uniform(0, side)
+        ring = []
+        for k in range(8):
+            angle = 2 * math.pi * k / 8
+            radius = size / 2 * rng.uniform(0.6, 1.0)
+            ring.append(QgsPointXY(cx + radius * math.cos(angle), cy + radius * math.sin(angle)))
+        feature = QgsFeature(fields, i + 1)
+        feature.setAttributes([f"B{i + 1}"])
+        feature.setGeometry(QgsGeometry.fromPolygonXY([ring]))
+        features.append(feature)
+    return features
+
+
+def write_blocks(path, features):
+    """Enregistre les blocs générés (identifiant, nom, WKB) pour les processus de mesure."""
+    with open(path, "wb") as f:
+        pickle.dump([(feature.id(), feature["nom"], bytes(feature.geometry().asWkb())) for feature in features], f)
+
+
+def load_blocks(path):
+    fields = QgsFields()
+    fields.append(QgsField('nom', QVariant.String))
+    with open(path, "rb") as f:
+        rows = pickle.load(f)
+    features = []
+    for fid, name, wkb in rows:
+        geometry = QgsGeometry()
+        geometry.fromWkb(wkb)
+        feature = QgsFeature(fields, fid)
+        feature.setAttributes([name])
+        feature.setGeometry(geometry)
+        features.append(feature)
+    return features
+
+
+def brute_force_pairs(features, distance):
+    """Ancienne méthode : chaque bloc est comparé à tous les autres."""
+    pairs = set()
+    distance_calls = 0
+    for feature in features:
+        geom = feature.geometry()
+        for other_feature in features:
+            if other_feature.id() != feature.id():
+                distance_calls += 1
+                if geom.distance(other_feature.geometry()) <= distance:
+                    pairs.add((min(feature.id(), other_feature.id()), max(feature.id(), other_feature.id())))
+    return pairs, distance_calls
+
+
+def load_postgis(features, connection_uri):
+    """Copie les blocs synthétiques dans la table de banc d'essai et retourne la couche PostGIS."""
+    crs = QgsCoordinateReferenceSystem("EPSG:32198")
+    mem_layer = QgsVectorLayer("Polygon", "blocs", "memory")
+    mem_layer.setCrs(crs)
+    mem_layer.dataProvider().addAttributes(features[0].fields().toList())
+    mem_layer.updateFields()
+    mem_layer.dataProvider().addFeatures(features)
+    uri = QgsDataSourceUri(connection_uri)
+    uri.setDataSource("public", BENCH_TABLE, "geom", "", "fid")
+    error, message = QgsVectorLayerExporter.exportLayer(mem_layer, uri.uri(), "postgres", crs, False,
+                                                        {"overwrite": True})[:2]
+    if error:
+        raise RuntimeError(message)
+    return QgsVectorLayer(uri.uri(), BENCH_TABLE, "postgres")
+
+
+def tenant_digest(tenant_dict):
+    """Empreinte des tenants, pour vérifier que tous les modes donnent le même résultat."""
+    return hashlib.sha1(repr(sorted(tenant_dict.items())).encode()).hexdigest()
+
+
+def peak_rss_mb(children=False):
+    """Mémoire résidente maximale (Mo) du processus, ou avec `children` du plus gros de ses
+    enfants terminés ; None sans `resource`. Les deux pics ne s'additionnent pas."""
+    if resource is None:
+        return None
+    kilobytes = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":  # ru_maxrss est en octets sous macOS
+        kilobytes /= 1024
+    return round(kilobytes / 1024, 1)
+
+
+def run_case(case):
+    """Exécute un cas (taille, mode, paramètres) et retourne ses mesures."""
+    features = load_blocks(case["donnees"])
+    distance = case["distance"]
+    result = dict(case)
+    del result["donnees"]
+    # Pic atteint au chargement des données, commun à tous les modes
+    result["rss_donnees_mo"] = peak_rss_mb()
+    start = time.perf_counter()
+    if case["mode"] == "naif":
+        pairs, distance_calls = brute_force_pairs(features, distance)
+        tenant_dict = cluster_tenants([feature.id() for feature in features], pairs)
+        result["appels_geos"] = {"distance": distance_calls}
+    elif case["mode"] == "postgis":
+        layer = load_postgis(features, case["postgres"])
+        del features
+        start = time.perf_counter()
+        records = postgis_tenants(layer, 'nom', distance, log=lambda message: None)
+        if records is None:
+            raise RuntimeError("calcul PostGIS impossible sur la table de banc d'essai")
+        tenant_dict = {record.id_original: record.tenant for record in records}
+        result["appels_geos"] = None
+    else:
+        blocs = list(read_blocs(features, 'nom', log=lambda message: None))
+        del features
+        tenant_dict, distance_calls = assign_tenants(blocs, distance, case["processus"])
+        result["appels_geos"] = {"distance": distance_calls}
+    result["temps_s"] = round(time.perf_counter() - start, 3)
+    result["rss_max_mo"] = peak_rss_mb()
+    result["rss_enfants_max_mo"] = peak_rss_mb(children=True)
+    result["tenants"] = len(set(tenant_dict.values()))
+    result["empreinte"] = tenant_digest(tenant_dict)
+    return result
+
+
+def run_case_in_subprocess(case):
+    """Exécute un cas dans un nouveau processus, pour une mesure de mémoire maximale qui lui est propre."""
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--cas", json.dumps(case)],
+                            capture_output=True, text=True)
+    if output.returncode != 0:
+        lines = output.stderr.strip().splitlines()
+        result = dict(case, erreur=lines[-1] if lines else f"code {output.returncode}")
+        del result["donnees"]
+        return result
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def generate_data_in_subprocess(params, path):
+    """Génère les blocs d'une taille dans un processus à part, hors des mesures de mémoire."""
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--generer", json.dumps(params), path], check=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_cases(args, data_folder):
+    cases = []
+    for count in args.blocs:
+        base = {"blocs": count, "distance": args.distance, "densite": args.densite,
+                "regroupement": args.regroupement, "graine": args.graine, "processus": 1,
+                "donnees": os.path.join(data_folder, f"blocs_{count}.pickle")}
+        for mode in args.modes:
+            if mode == "naif" and count > args.naif_max:
+                continue
+            if mode == "postgis":
+                if args.postgres:
+                    cases.append(dict(base, mode=mode, postgres=args.postgres))
+            elif mode == "parallele":
+                cases.extend(dict(base, mode=mode, processus=workers) for workers in args.processus)
+            else:
+                cases.append(dict(base, mode=mode))
+    return cases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Banc d'essai du calcul des tenants.")
+    parser.add_argument("--blocs", type=int, nargs="+", default=[1000, 10000, 100000, 500000])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=["naif", "index", "parallele"])
+    parser.add_argument("--distance", type=float, default=60)
+    parser.add_argument("--densite", type=float, default=0.3, help="Part du territoire couverte par les blocs")
+    parser.add_argument("--regroupement", type=float, default=0.5, help="Part des blocs groupés en chantiers")
+    parser.add_argument("--graine", type=int, default=0)
+    parser.add_argument("--processus", type=int, nargs="+", default=[os.cpu_count() or 2],
+                        help="Nombres de processus du mode parallele")
+    parser.add_argument("--naif-max", type=int, default=5000, help="Taille maximale pour le mode naif")
+    parser.add_argument("--postgres", help="URI de connexion PostgreSQL du mode postgis")
+    parser.add_argument("--json", help="Fichier JSON des résultats")
+    parser.add_argument("--cas", help=argparse.SUPPRESS)
+    parser.add_argument("--generer", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if not args.cas and not args.generer:
+        return run_suite(args)
+
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    try:
+        if args.generer:
+            params = json.loads(args.generer[0])
+            write_blocks(args.generer[1], synthetic_blocks(params["blocs"], params["densite"],
+                                                           params["regroupement"], seed=params["graine"]))
+        else:
+            print(json.dumps(run_case(json.loads(args.cas))))
+    finally:
+        qgs.exitQgis()
+    return 0
+
+
+def run_suite(args):
+    results = []
+    reference = {}
+    data_folder = tempfile.mkdtemp(prefix="bench_tenants_")
+    print(f"{'blocs':>8} {'mode':>10} {'proc.':>6} {'temps (s)':>10} {'données':>9} {'RSS (Mo)':>9} "
+          f"{'enfants':>9} {'distance()':>12} {'tenants':>8}")
+    try:
+        for case in build_cases(args, data_folder):
+            if not os.path.exists(case["donnees"]):
+                generate_data_in_subprocess(case, case["donnees"])
+            result = run_case_in_subprocess(case)
+            results.append(result)
+            if "erreur" in result:
+                print(f"{case['blocs']:>8} {case['mode']:>10} [ERREUR] {result['erreur']}")
+                continue
+            # Tous les modes doivent donner les mêmes tenants pour une même taille
+            result["identique"] = reference.setdefault(case["blocs"], result["empreinte"]) == result["empreinte"]
+            data_rss, rss, children_rss = (
+                value if value is not None else "-"
+                for value in (result["rss_donnees_mo"], result["rss_max_mo"], result["rss_enfants_max_mo"])
+            )
+            calls = (result["appels_geos"] or {}).get("distance", "-")
+            print(f"{case['blocs']:>8} {case['mode']:>10} {case['processus']:>6} {result['temps_s']:>10.2f} "
+                  f"{data_rss:>9} {rss:>9} {children_rss:>9} {calls:>12} {result['tenants']:>8}"
+                  f"{'' if result['identique'] else '  [DIFFÉRENT]'}")
+    finally:
+        shutil.rmtree(data_folder, ignore_errors=True)
+
+    if args.json:
+        report = {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "machine": {"plateforme": platform.platform(), "python": platform.python_version(),
+                        "qgis": Qgis.QGIS_VERSION, "processeurs": os.cpu_count()},
+            "resultats": results,
+        }
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Résultats écrits dans {args.json}")
+    return 1 if any("erreur" in result or not result.get("identique", True) for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
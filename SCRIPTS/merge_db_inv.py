@@ -1,81 +1,547 @@
+import argparse
+import datetime
+import hashlib
+import multiprocessing
 import os
+import re
 import sqlite3
-from qgis.PyQt.QtWidgets import QFileDialog
+import sys
+import time
+from queue import Empty
 
-def get_table_names(conn):
+STREAM_BATCH_ROWS = 5000
+# Lots en attente entre chaque lecteur et l'écrivain du mode pipeline
+QUEUE_BATCHES = 8
+# Table de la base fusionnée qui recense les sources déjà fusionnées (mode incrémental)
+MANIFEST_TABLE = "fusion_sources"
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def get_table_names(conn, schema="main"):
     cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
+    cursor.execute(
+        f"SELECT name FROM {schema}.sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name != ?;",
+        (MANIFEST_TABLE,)
+    )
     return [row[0] for row in cursor.fetchall()]
 
-def table_has_column(conn, table_name, column_name):
+def get_column_types(conn, table_name, schema="main"):
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA {schema}.table_info({quote_ident(table_name)});")
+    return [(row[1], row[2]) for row in cursor.fetchall()]
+
+def get_columns(conn, table_name, schema="main"):
+    return [col for col, _ in get_column_types(conn, table_name, schema)]
+
+def get_create_sql(conn, table_name, schema="main"):
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT sql FROM {schema}.sqlite_master WHERE type='table' AND name=?;", (table_name,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def get_index_sql(conn, table_name, schema="main"):
+    """Instructions CREATE INDEX explicites de la table (les index automatiques des
+    contraintes PRIMARY KEY/UNIQUE font partie du CREATE TABLE)."""
     cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info('{table_name}');")
-    return any(row[1].upper() == column_name.upper() for row in cursor.fetchall())
-
-def create_table_if_not_exists(conn_dst, conn_src, table_name):
-    cursor_src = conn_src.cursor()
-    cursor_dst = conn_dst.cursor()
-    cursor_src.execute(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table_name}';")
-    create_sql = cursor_src.fetchone()
-    if create_sql:
+    cursor.execute(
+        f"SELECT sql FROM {schema}.sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL;",
+        (table_name,)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def if_not_exists(create_index_sql):
+    return re.sub(r"^\s*CREATE\s+(UNIQUE\s+)?INDEX\s+(?!IF\s+NOT\s+EXISTS)",
+                  lambda m: f"CREATE {m.group(1) or ''}INDEX IF NOT EXISTS ", create_index_sql, flags=re.I)
+
+def log_table(log, table, name, added, read, seconds):
+    """Bilan d'une table ; `read` vaut None quand les lignes lues ne sont pas comptées (ATTACH)."""
+    if read is None:
+        log(f"{added} ligne(s) ajoutée(s) dans {table} depuis {name} ({seconds:.2f} s).")
+        return
+    if not read:
+        log(f"Aucune donnée à insérer dans {table} depuis {name}.")
+        return
+    rate = f"{read / seconds:.0f} lignes/s" if seconds else "-"
+    log(f"{added} ligne(s) ajoutée(s) sur {read} lue(s) dans {table} depuis {name} ({rate}).")
+
+def source_filter(table_name, columns):
+    """Clause WHERE propre à une table : seules les parcelles réalisées sont fusionnées."""
+    if table_name.upper() == "PARCELLE" and any(col.upper() == "PARETATSUIVI" for col in columns):
+        return " WHERE UPPER(PARETATSUIVI) = 'REALISE'"
+    return ""
+
+def scan_source(db_file):
+    """Lit une fois le schéma d'une source : {table: (CREATE, [(colonne, type)], [CREATE INDEX])}."""
+    conn_src = sqlite3.connect(db_file)
+    try:
+        return {
+            table: (get_create_sql(conn_src, table), get_column_types(conn_src, table), get_index_sql(conn_src, table))
+            for table in get_table_names(conn_src)
+        }
+    finally:
+        conn_src.close()
+
+def plan_merge(db_files, log=print):
+    """Phase de planification : parcourt une fois le schéma de toutes les sources.
+
+    Construit le schéma unifié de chaque table (colonnes de la première source qui la
+    contient, puis colonnes apparues dans les versions suivantes de l'application) et,
+    pour chaque source, la liste des colonnes à copier et le filtre de chaque table :
+    l'ordre et l'ensemble des colonnes peuvent varier d'une source à l'autre. Les
+    sources illisibles sont signalées et écartées. Retourne
+    {"tables": {table: {"create", "columns", "unique", "indexes"}},
+     "sources": {fichier: {table: (colonnes, filtre)}}}.
+    """
+    tables = {}
+    sources = {}
+    for db_file in db_files:
+        try:
+            schema = scan_source(db_file)
+        except sqlite3.Error as e:
+            log(f"Erreur de lecture de {os.path.basename(db_file)} : {e}")
+            continue
+        layout = {}
+        for table, (create_sql, column_types, index_sql) in schema.items():
+            if not create_sql:
+                continue
+            plan = tables.setdefault(table, {"create": create_sql, "columns": {}, "unique": {}, "indexes": {}})
+            for col, col_type in column_types:
+                plan["columns"].setdefault(col.lower(), (col, col_type))
+            for sql in index_sql:
+                # Les index UNIQUE décident des doublons ignorés : ils restent en place pendant
+                # le chargement, les autres sont construits à la fin
+                kind = "unique" if re.match(r"\s*CREATE\s+UNIQUE\b", sql, re.I) else "indexes"
+                plan[kind].setdefault(re.sub(r"\s+", " ", sql.strip()).lower(), sql)
+            cols = [col for col, _ in column_types]
+            layout[table] = (cols, source_filter(table, cols))
+        sources[db_file] = layout
+    return {"tables": tables, "sources": sources}
+
+def prepare_destination(conn_dst, plan, log=print):
+    """Crée les tables du plan dans la base de sortie, sans leurs index secondaires, et
+    ajoute les colonnes qui manquent à celles qui existent déjà."""
+    for table, table_plan in plan["tables"].items():
+        existing = {col.lower() for col in get_columns(conn_dst, table)}
+        if not existing:
+            # Sans préfixe de schéma, CREATE TABLE crée la table dans main
+            conn_dst.execute(table_plan["create"])
+            existing = {col.lower() for col in get_columns(conn_dst, table)}
+        for key, (col, col_type) in table_plan["columns"].items():
+            if key not in existing:
+                conn_dst.execute(f"ALTER TABLE {quote_ident(table)} ADD COLUMN {quote_ident(col)} {col_type};")
+                log(f"Colonne {col} ajoutée à {table}.")
+        for sql in table_plan["unique"].values():
+            conn_dst.execute(if_not_exists(sql))
+
+def finish_destination(conn_dst, plan, log=print):
+    """Construit les index secondaires une fois les données chargées, puis ANALYZE."""
+    start = time.perf_counter()
+    count = 0
+    for table, table_plan in plan["tables"].items():
+        for sql in table_plan["indexes"].values():
+            try:
+                conn_dst.execute(if_not_exists(sql))
+                count += 1
+            except sqlite3.Error as e:
+                log(f"Index de {table} non créé : {e}")
+    conn_dst.execute("ANALYZE;")
+    log(f"{count} index construit(s) et statistiques mises à jour en {time.perf_counter() - start:.1f} s.")
+
+def rollback_source(conn_dst, name, log=print):
+    """Annule la fusion en cours d'une source : elle n'est pas inscrite au manifeste et
+    sera reprise au prochain passage incrémental."""
+    conn_dst.execute("ROLLBACK;")
+    log(f"Fusion de {name} annulée.")
+    return None
+
+def merge_database(conn_dst, db_file, layout, batch_rows=STREAM_BATCH_ROWS, log=print):
+    """Fusionne une base source dans la base de sortie ouverte par `conn_dst`.
+
+    `layout` est l'entrée de la source dans le plan (voir plan_merge). La source est
+    attachée (ATTACH) à la connexion de sortie et chaque table est copiée par une seule
+    instruction INSERT OR IGNORE ... SELECT : les lignes ne passent pas par Python. Les
+    lignes lues ne sont pas comptées (None) : un count(*) relirait toute la source. Toute la source est fusionnée dans une transaction, annulée à la première
+    erreur d'insertion. Une source qui ne peut pas être attachée est fusionnée en flux.
+    Retourne {table: (lignes ajoutées, lignes lues, secondes)}, ou None si la source a
+    été annulée.
+    """
+    name = os.path.basename(db_file)
+    stats = {}
+    try:
+        conn_dst.execute("ATTACH DATABASE ? AS src;", (db_file,))
+    except sqlite3.OperationalError as e:
+        log(f"ATTACH impossible pour {name} ({e}) : fusion en flux.")
+        return merge_database_streaming(conn_dst, db_file, layout, batch_rows, log)
+    try:
+        conn_dst.execute("BEGIN;")
+        for table, (cols, where) in layout.items():
+            cols_str = ", ".join(quote_ident(col) for col in cols)
+            start = time.perf_counter()
+            before = conn_dst.total_changes
+            try:
+                conn_dst.execute(
+                    f"INSERT OR IGNORE INTO main.{quote_ident(table)} ({cols_str}) "
+                    f"SELECT {cols_str} FROM src.{quote_ident(table)}{where};"
+                )
+            except sqlite3.Error as e:
+                log(f"Erreur d'insertion dans {table} ({name}) : {e}")
+                return rollback_source(conn_dst, name, log)
+            stats[table] = (conn_dst.total_changes - before, None, time.perf_counter() - start)
+            log_table(log, table, name, *stats[table])
+        conn_dst.execute("COMMIT;")
+    except Exception:
+        if conn_dst.in_transaction:
+            conn_dst.execute("ROLLBACK;")
+        raise
+    finally:
+        conn_dst.execute("DETACH DATABASE src;")
+    return stats
+
+def insert_sql(table, cols):
+    return (
+        f"INSERT OR IGNORE INTO main.{quote_ident(table)} ({', '.join(quote_ident(col) for col in cols)}) "
+        f"VALUES ({', '.join(['?'] * len(cols))});"
+    )
+
+def iter_source_batches(conn_src, table, cols, where, batch_rows=STREAM_BATCH_ROWS):
+    """Lignes à fusionner d'une table source, filtrées, par lots de `batch_rows` (fetchmany)."""
+    cursor_src = conn_src.execute(
+        f"SELECT {', '.join(quote_ident(col) for col in cols)} FROM {quote_ident(table)}{where};"
+    )
+    while True:
+        rows = cursor_src.fetchmany(batch_rows)
+        if not rows:
+            break
+        yield rows
+
+def stream_table(conn_src, conn_dst, table, cols, where, batch_rows=STREAM_BATCH_ROWS):
+    """Copie une table de `conn_src` vers la base de sortie par lots de `batch_rows` lignes.
+
+    Le curseur source est lu avec fetchmany et chaque lot inséré avec executemany :
+    la mémoire utilisée ne dépend que de la taille des lots. Retourne (ajoutées, lues).
+    """
+    sql = insert_sql(table, cols)
+    before = conn_dst.total_changes
+    read = 0
+    for rows in iter_source_batches(conn_src, table, cols, where, batch_rows):
+        conn_dst.executemany(sql, rows)
+        read += len(rows)
+    return conn_dst.total_changes - before, read
+
+def merge_database_streaming(conn_dst, db_file, layout, batch_rows=STREAM_BATCH_ROWS, log=print):
+    """Fusionne une base source en faisant passer ses lignes par Python, en flux.
+
+    Pour les sources qui ne peuvent pas être attachées à la base de sortie (encodage
+    de texte différent, par exemple). Même résultat, même transaction par source et même
+    valeur de retour que merge_database.
+    """
+    name = os.path.basename(db_file)
+    stats = {}
+    conn_src = sqlite3.connect(db_file)
+    try:
+        conn_dst.execute("BEGIN;")
+        for table, (cols, where) in layout.items():
+            start = time.perf_counter()
+            try:
+                added, read = stream_table(conn_src, conn_dst, table, cols, where, batch_rows)
+            except sqlite3.Error as e:
+                log(f"Erreur d'insertion dans {table} ({name}) : {e}")
+                return rollback_source(conn_dst, name, log)
+            stats[table] = (added, read, time.perf_counter() - start)
+            log_table(log, table, name, *stats[table])
+        conn_dst.execute("COMMIT;")
+    except Exception:
+        if conn_dst.in_transaction:
+            conn_dst.execute("ROLLBACK;")
+        raise
+    finally:
+        conn_src.close()
+    return stats
+
+def read_sources(db_files, layouts, batch_rows, queue):
+    """Lecteur du mode pipeline : envoie les tables de ses sources à l'écrivain, par lots.
+
+    Messages (type, table, contenu), dans l'ordre des sources : « lot » (lignes),
+    « fin_table » (lignes lues), « erreur » (message) et « fin », toujours envoyé en
+    dernier pour chaque source.
+    """
+    for db_file, layout in zip(db_files, layouts):
         try:
-            cursor_dst.execute(create_sql[0])
-            conn_dst.commit()
-        except sqlite3.OperationalError:
-            # Table exists
-            pass
-
-# Sélection du dossier contenant les fichiers .db
-folder = QFileDialog.getExistingDirectory(None, "Sélectionner le dossier contenant les fichiers .db")
-if not folder:
-    print("Aucun dossier sélectionné.")
-    raise Exception("Script arrêté, aucun dossier sélectionné.")
-
-# Sélection du fichier de sortie
-output_path, _ = QFileDialog.getSaveFileName(None, "Nommer la base fusionnée", folder, "Base de données (*.db)")
-if not output_path:
-    print("Aucun fichier de sortie spécifié.")
-    raise Exception("Script arrêté, aucun fichier de sortie.")
-
-# Recherche des fichiers .db dans le dossier
-db_files = [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith('.db')]
-
-if not db_files:
-    print("Aucun fichier .db trouvé dans le dossier.")
-    raise Exception("Aucun fichier .db à traiter.")
-
-for idx, db_file in enumerate(db_files):
-    print(f"Traitement de {os.path.basename(db_file)} ...")
-    with sqlite3.connect(db_file) as conn_src, sqlite3.connect(output_path) as conn_dst:
-        table_names = get_table_names(conn_src)
-        for table in table_names:
-            # Créer la table si elle n'existe pas encore dans la base de sortie
-            create_table_if_not_exists(conn_dst, conn_src, table)
-            cursor_src = conn_src.cursor()
-            cursor_dst = conn_dst.cursor()
-            # Liste des colonnes
-            cursor_src.execute(f"PRAGMA table_info('{table}');")
-            cols = [row[1] for row in cursor_src.fetchall()]
-            cols_str = ", ".join([f'"{col}"' for col in cols])
-            placeholders = ", ".join(["?"] * len(cols))
-            # Cas particulier pour la table PARCELLE
-            if table.upper() == "PARCELLE" and table_has_column(conn_src, table, "PARETATSUIVI"):
-                cursor_src.execute(f'''SELECT {cols_str} FROM "{table}" WHERE UPPER(PARETATSUIVI) = "REALISE";''')
-            else:
-                cursor_src.execute(f'''SELECT {cols_str} FROM "{table}";''')
-            rows = cursor_src.fetchall()
-            if rows:
-                for row in rows:
+            conn_src = sqlite3.connect(db_file)
+            try:
+                for table, (cols, where) in layout.items():
+                    read = 0
+                    for rows in iter_source_batches(conn_src, table, cols, where, batch_rows):
+                        queue.put(("lot", table, rows))
+                        read += len(rows)
+                    queue.put(("fin_table", table, read))
+            finally:
+                conn_src.close()
+        except Exception as e:
+            queue.put(("erreur", None, str(e)))
+        finally:
+            queue.put(("fin", None, None))
+
+def _next_message(queue, reader):
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not reader.is_alive():
+                raise RuntimeError(f"le processus lecteur {reader.name} s'est arrêté")
+
+def merge_databases_pipelined(db_files, output_path, plan, readers, batch_rows=STREAM_BATCH_ROWS,
+                              queue_batches=QUEUE_BATCHES, on_merged=None, log=print):
+    """Fusionne les sources avec `readers` processus lecteurs et un seul écrivain.
+
+    Les sources sont réparties à tour de rôle entre les lecteurs, qui les ouvrent, les
+    filtrent et les lisent en parallèle ; chacun a sa file bornée à `queue_batches` lots,
+    la mémoire reste donc bornée quel que soit le nombre de sources. Seul le processus
+    courant écrit dans la base de sortie, source par source dans l'ordre et dans une
+    transaction par source : le résultat est celui de la fusion séquentielle.
+    `on_merged(conn_dst, fichier, stats)` est appelé après chaque source validée.
+    Retourne {fichier: {table: (ajoutées, lues, secondes)}} pour les sources validées.
+    """
+    context = multiprocessing.get_context("spawn")
+    readers = max(1, min(readers, len(db_files)))
+    queues = [context.Queue(maxsize=max(1, queue_batches)) for _ in range(readers)]
+    layouts = [plan["sources"][db_file] for db_file in db_files]
+    processes = [
+        context.Process(target=read_sources, daemon=True,
+                        args=(db_files[i::readers], layouts[i::readers], batch_rows, queues[i]))
+        for i in range(readers)
+    ]
+    for process in processes:
+        process.start()
+    stats = {}
+    conn_dst = sqlite3.connect(output_path, isolation_level=None)
+    try:
+        for i, db_file in enumerate(db_files):
+            name = os.path.basename(db_file)
+            log(f"Traitement de {name} ...")
+            stats[db_file] = {}
+            table_state = {}
+            failed = False
+            conn_dst.execute("BEGIN;")
+            while True:
+                kind, table, payload = _next_message(queues[i % readers], processes[i % readers])
+                if kind == "fin":
+                    break
+                if table is not None and table not in table_state:
+                    cols = plan["sources"][db_file][table][0]
+                    table_state[table] = [insert_sql(table, cols), 0, time.perf_counter()]
+                if kind == "lot" and table_state[table]:
+                    before = conn_dst.total_changes
                     try:
-                        cursor_dst.execute(
-                            f'INSERT OR IGNORE INTO "{table}" ({cols_str}) VALUES ({placeholders});', row
-                        )
-                    except Exception as e:
-                        print(f"Erreur d'insertion dans {table} ({os.path.basename(db_file)}) : {e}")
-                conn_dst.commit()
-                print(f"{len(rows)} ligne(s) ajoutée(s) dans {table} depuis {os.path.basename(db_file)}.")
-            else:
-                print(f"Aucune donnée à insérer dans {table} depuis {os.path.basename(db_file)}.")
-
-print("Fusion terminée !")
-print(f"Base fusionnée créée ici : {output_path}")
+                        conn_dst.executemany(table_state[table][0], payload)
+                    except sqlite3.Error as e:
+                        log(f"Erreur d'insertion dans {table} ({name}) : {e}")
+                        table_state[table] = None
+                        failed = True
+                        continue
+                    table_state[table][1] += conn_dst.total_changes - before
+                elif kind == "fin_table" and table_state[table]:
+                    _, added, start = table_state.pop(table)
+                    stats[db_file][table] = (added, payload, time.perf_counter() - start)
+                    log_table(log, table, name, *stats[db_file][table])
+                elif kind == "erreur":
+                    log(f"Erreur de lecture de {name} : {payload}")
+                    failed = True
+            # Comme en séquentiel, une source en erreur n'est pas fusionnée à moitié
+            if failed:
+                rollback_source(conn_dst, name, log)
+                del stats[db_file]
+                continue
+            conn_dst.execute("COMMIT;")
+            if on_merged:
+                on_merged(conn_dst, db_file, stats[db_file])
+    except Exception:
+        if conn_dst.in_transaction:
+            conn_dst.execute("ROLLBACK;")
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        conn_dst.close()
+    for process in processes:
+        process.join()
+    return stats
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ensure_manifest(conn_dst):
+    conn_dst.execute(
+        f"CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} ("
+        "chemin TEXT PRIMARY KEY, taille INTEGER, mtime REAL, empreinte TEXT, "
+        "fusionne_le TEXT, lignes_lues INTEGER, lignes_ajoutees INTEGER);"
+    )
+
+def plan_incremental(conn_dst, db_files, log=print):
+    """Sépare les sources nouvelles ou modifiées de celles déjà fusionnées.
+
+    Une source dont la taille et la date de modification n'ont pas changé n'est pas
+    relue ; sinon son empreinte SHA-256 est comparée à celle du manifeste (une source
+    seulement « touchée » n'est pas refusionnée). Retourne ({fichier: (taille, mtime,
+    empreinte)} à fusionner, [fichiers inchangés]).
+    """
+    ensure_manifest(conn_dst)
+    known = {
+        row[0]: row[1:]
+        for row in conn_dst.execute(f"SELECT chemin, taille, mtime, empreinte FROM {MANIFEST_TABLE};")
+    }
+    to_merge = {}
+    unchanged = []
+    for db_file in db_files:
+        path = os.path.abspath(db_file)
+        stat = os.stat(path)
+        previous = known.get(path)
+        if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime:
+            unchanged.append(db_file)
+            continue
+        digest = file_hash(path)
+        if previous and previous[2] == digest:
+            conn_dst.execute(
+                f"UPDATE {MANIFEST_TABLE} SET taille = ?, mtime = ? WHERE chemin = ?;",
+                (stat.st_size, stat.st_mtime, path)
+            )
+            unchanged.append(db_file)
+            continue
+        log(f"{os.path.basename(db_file)} : {'modifiée' if previous else 'nouvelle'}.")
+        to_merge[db_file] = (stat.st_size, stat.st_mtime, digest)
+    return to_merge, unchanged
+
+def manifest_recorder(entries, log=print):
+    """Rappel `on_merged` du mode incrémental : inscrit la source au manifeste et
+    affiche le bilan des lignes qu'elle a apportées."""
+    def record(conn_dst, db_file, stats):
+        counts = [table_stats[1] for table_stats in stats.values()]
+        read = None if None in counts else sum(counts)
+        added = sum(table_stats[0] for table_stats in stats.values())
+        size, mtime, digest = entries[db_file]
+        conn_dst.execute(
+            f"INSERT OR REPLACE INTO {MANIFEST_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (os.path.abspath(db_file), size, mtime, digest,
+             datetime.datetime.now().isoformat(timespec="seconds"), read, added)
+        )
+        read_text = "" if read is None else f" sur {read} lue(s)"
+        log(f"Bilan {os.path.basename(db_file)} : +{added} ligne(s){read_text}, {len(stats)} table(s).")
+    return record
+
+def merge_databases(db_files, output_path, streaming=False, batch_rows=STREAM_BATCH_ROWS, readers=0,
+                    incremental=False, log=print):
+    """Fusionne les bases `db_files` dans `output_path` avec une seule connexion de sortie.
+
+    Les sources sont attachées à la base de sortie ; avec `streaming`, ou si une source
+    ne peut pas être attachée, ses lignes passent en flux par Python. Avec `readers`,
+    les sources sont lues en parallèle (voir merge_databases_pipelined). Avec
+    `incremental`, seules les sources nouvelles ou modifiées depuis la dernière fusion
+    sont traitées (voir plan_incremental). Le schéma des sources est planifié d'abord
+    (voir plan_merge) ; les index secondaires sont construits à la fin. Retourne les
+    statistiques par source validée.
+    """
+    on_merged = None
+    if incremental:
+        conn_dst = sqlite3.connect(output_path, isolation_level=None)
+        try:
+            entries, unchanged = plan_incremental(conn_dst, db_files, log)
+        finally:
+            conn_dst.close()
+        log(f"{len(unchanged)} source(s) inchangée(s), {len(entries)} à fusionner.")
+        db_files = [db_file for db_file in db_files if db_file in entries]
+        on_merged = manifest_recorder(entries, log)
+        if not db_files:
+            return {}
+
+    plan = plan_merge(db_files, log)
+    db_files = [db_file for db_file in db_files if db_file in plan["sources"]]
+    stats = {}
+    conn_dst = sqlite3.connect(output_path, isolation_level=None)
+    try:
+        prepare_destination(conn_dst, plan, log)
+        if readers:
+            stats = merge_databases_pipelined(db_files, output_path, plan, readers, batch_rows,
+                                              on_merged=on_merged, log=log)
+        else:
+            for db_file in db_files:
+                log(f"Traitement de {os.path.basename(db_file)} ...")
+                if streaming:
+                    file_stats = merge_database_streaming(conn_dst, db_file, plan["sources"][db_file],
+                                                          batch_rows, log)
+                else:
+                    file_stats = merge_database(conn_dst, db_file, plan["sources"][db_file], batch_rows, log)
+                if file_stats is None:
+                    continue
+                stats[db_file] = file_stats
+                if on_merged:
+                    on_merged(conn_dst, db_file, stats[db_file])
+        finish_destination(conn_dst, plan, log)
+    finally:
+        conn_dst.close()
+    return stats
+
+def find_db_files(folder, output_path=None):
+    """Fichiers .db du dossier, sans la base de sortie si elle s'y trouve."""
+    output = os.path.abspath(output_path) if output_path else None
+    return [
+        os.path.join(folder, f) for f in sorted(os.listdir(folder))
+        if f.lower().endswith('.db') and os.path.abspath(os.path.join(folder, f)) != output
+    ]
+
+def run_from_qgis():
+    from qgis.PyQt.QtWidgets import QFileDialog
+
+    # Sélection du dossier contenant les fichiers .db
+    folder = QFileDialog.getExistingDirectory(None, "Sélectionner le dossier contenant les fichiers .db")
+    if not folder:
+        print("Aucun dossier sélectionné.")
+        raise Exception("Script arrêté, aucun dossier sélectionné.")
+
+    # Sélection du fichier de sortie
+    output_path, _ = QFileDialog.getSaveFileName(None, "Nommer la base fusionnée", folder, "Base de données (*.db)")
+    if not output_path:
+        print("Aucun fichier de sortie spécifié.")
+        raise Exception("Script arrêté, aucun fichier de sortie.")
+
+    run(folder, output_path)
+
+def run(folder, output_path, streaming=False, batch_rows=STREAM_BATCH_ROWS, readers=0, incremental=False):
+    # Recherche des fichiers .db dans le dossier
+    db_files = find_db_files(folder, output_path)
+    if not db_files:
+        print("Aucun fichier .db trouvé dans le dossier.")
+        raise Exception("Aucun fichier .db à traiter.")
+
+    merge_databases(db_files, output_path, streaming, batch_rows, readers, incremental)
+    print("Fusion terminée !")
+    print(f"Base fusionnée créée ici : {output_path}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fusionne les bases d'inventaire .db d'un dossier.")
+    parser.add_argument("dossier", help="Dossier contenant les fichiers .db")
+    parser.add_argument("sortie", help="Base fusionnée à créer ou compléter")
+    parser.add_argument("--flux", action="store_true",
+                        help="Fait passer les lignes par Python, par lots (sans ATTACH)")
+    parser.add_argument("--lot", type=int, default=STREAM_BATCH_ROWS,
+                        help="Lignes par lot en mode --flux ou --lecteurs")
+    parser.add_argument("--lecteurs", type=int, default=0,
+                        help="Processus lisant les sources en parallèle pour un seul écrivain (0 : séquentiel)")
+    parser.add_argument("--incremental", action="store_true",
+                        help=f"Ne fusionne que les sources nouvelles ou modifiées (manifeste {MANIFEST_TABLE})")
+    args = parser.parse_args(argv)
+    try:
+        run(args.dossier, args.sortie, args.flux, args.lot, args.lecteurs, args.incremental)
+    except Exception as e:
+        print(e)
+        return 1
+    return 0
+
+if "iface" in globals():
+    run_from_qgis()
+elif __name__ == "__main__":
+    sys.exit(main())
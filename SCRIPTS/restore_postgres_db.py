@@ -0,0 +1,336 @@
+"""Restauration dans PostGIS des fichiers produits par backup_postgres_db.py.
+
+Chaque couche d'un fichier .gpkg ou .sqlite (un fichier par table ou un GeoPackage
+commun) est rechargée par COPY ... FROM STDIN, les lignes étant lues en flux dans
+SQLite. Les tables sont chargées en parallèle (un processus par table, les plus
+grosses d'abord) ; clé primaire, index spatial et ANALYZE viennent après le
+chargement. QGIS n'est pas nécessaire.
+
+    python restore_postgres_db.py /srv/sauvegardes/sig --postgres "service=sig_restau"
+    python restore_postgres_db.py sig.gpkg --postgres "host=serveur dbname=sig user=admin" --processus 8 --remplacer
+
+Le manifeste de sauvegarde (backup_manifest.json) donne la table d'origine et sa
+clé primaire ; la colonne FID ajoutée par la sauvegarde (fid, ogc_fid) n'est pas
+restaurée. Sans manifeste, les tables sont créées dans --schema sous le nom de la
+couche et une colonne FID nommée fid ou ogc_fid[_n] est considérée comme ajoutée.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+import psycopg2
+
+COPY_FETCH_ROWS = 10000
+
+# Type déclaré dans SQLite / GeoPackage -> type PostgreSQL
+PG_TYPES = {
+    "INTEGER": "bigint", "BIGINT": "bigint", "INT": "integer", "MEDIUMINT": "integer",
+    "SMALLINT": "smallint", "TINYINT": "smallint", "BOOLEAN": "boolean",
+    "REAL": "double precision", "DOUBLE": "double precision", "FLOAT": "real",
+    "DATE": "date", "DATETIME": "timestamp", "BLOB": "bytea",
+}
+
+COPY_TEXT_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+# Tables de métadonnées OGR / SpatiaLite d'un fichier .sqlite, qui ne sont pas des données
+SQLITE_METADATA_TABLES = {
+    "geometry_columns", "geometry_columns_auth", "geometry_columns_statistics",
+    "geometry_columns_field_infos", "geometry_columns_time", "views_geometry_columns",
+    "virts_geometry_columns", "spatial_ref_sys", "spatial_ref_sys_aux", "spatialite_history",
+    "sql_statements_log", "spatialindex", "elementarygeometries", "knn", "knn2", "data_licenses",
+}
+SYNTHETIC_FID_RE = re.compile(r"^(fid|ogc_fid(_\d+)?)$", re.IGNORECASE)
+
+# Taille de l'enveloppe de l'en-tête GeoPackage selon son indicateur (bits 1 à 3)
+GPKG_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def gpkg_geometry_to_wkb(blob):
+    """Retire l'en-tête GeoPackage (magic, version, indicateurs, SRID, enveloppe) et retourne le WKB."""
+    if blob is None:
+        return None
+    blob = bytes(blob)
+    if blob[:2] != b"GP":
+        return blob  # déjà du WKB (SpatiaLite / OGR sans en-tête)
+    flags = blob[3]
+    return blob[8 + GPKG_ENVELOPE_SIZES[(flags >> 1) & 0x07]:]
+
+def _pg_type(declared):
+    base = (declared or "").upper().split("(")[0].strip()
+    if base.startswith("VARCHAR") or base.startswith("TEXT") or not base:
+        return "text"
+    return PG_TYPES.get(base, "text")
+
+def _copy_value(value, kind):
+    """Valeur SQLite -> champ du format texte de COPY."""
+    if value is None:
+        return "\\N"
+    if kind == "boolean":
+        return "t" if value else "f"
+    if kind == "bytea":
+        return "\\\\x" + bytes(value).hex()
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return str(value).translate(COPY_TEXT_ESCAPES)
+
+class SqliteCopyReader:
+    """Fichier lu par COPY ... FROM STDIN (format texte), alimenté en flux par un curseur SQLite."""
+
+    def __init__(self, cursor, kinds, geom_index=None, srid=None):
+        self.cursor = cursor
+        self.kinds = kinds
+        self.geom_index = geom_index
+        self.geom_prefix = f"SRID={srid};" if srid else ""
+        self.buffer = b""
+        self.rows = 0
+        self.bytes = 0
+        self.done = False
+
+    def _format_row(self, row):
+        fields = []
+        for i, (value, kind) in enumerate(zip(row, self.kinds)):
+            if i == self.geom_index:
+                wkb = gpkg_geometry_to_wkb(value)
+                fields.append("\\N" if wkb is None else self.geom_prefix + wkb.hex())
+            else:
+                fields.append(_copy_value(value, kind))
+        return "\t".join(fields) + "\n"
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            rows = self.cursor.fetchmany(COPY_FETCH_ROWS)
+            if not rows:
+                self.done = True
+                break
+            self.buffer += "".join(self._format_row(row) for row in rows).encode("utf-8")
+            self.rows += len(rows)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.bytes += len(data)
+        return data
+
+    readline = read
+
+def list_layers(path):
+    """Couches d'un fichier : [{nom, colonnes, géométrie, srid, type, FID, lignes}].
+
+    Le FID est la colonne INTEGER PRIMARY KEY de la couche, s'il y en a une.
+    """
+    db = sqlite3.connect(path)
+    try:
+        is_gpkg = bool(db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'gpkg_contents';"
+        ).fetchone())
+        geometry = {}
+        if is_gpkg:
+            names = [row[0] for row in db.execute(
+                "SELECT table_name FROM gpkg_contents WHERE data_type IN ('features', 'attributes');"
+            )]
+            for table_name, column, geom_type, z, m, srid in db.execute("""
+                SELECT g.table_name, g.column_name, g.geometry_type_name, g.z, g.m,
+                       CASE WHEN upper(s.organization) = 'EPSG' THEN s.organization_coordsys_id ELSE g.srs_id END
+                FROM gpkg_geometry_columns g
+                LEFT JOIN gpkg_spatial_ref_sys s ON s.srs_id = g.srs_id;
+            """):
+                suffix = ("Z" if z else "") + ("M" if m else "")
+                geometry[table_name] = (column, geom_type.upper() + suffix, srid if srid and srid > 0 else None)
+        else:
+            tables = db.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%';"
+            ).fetchall()
+            # Index spatiaux : tables virtuelles (R-tree) et leurs tables _node, _parent, _rowid
+            virtual = {name for name, sql in tables if (sql or "").upper().startswith("CREATE VIRTUAL TABLE")}
+            names = [
+                name for name, _ in tables
+                if name.lower() not in SQLITE_METADATA_TABLES and name not in virtual
+                and not any(name.endswith(suffix) and name[:-len(suffix)] in virtual
+                            for suffix in ("_node", "_parent", "_rowid"))
+            ]
+        layers = []
+        for name in names:
+            columns = db.execute(f"PRAGMA table_info({quote_ident(name)});").fetchall()
+            key_columns = [column for column in columns if column[5]]
+            geom_column, geom_type, srid = geometry.get(name, (None, None, None))
+            layers.append({
+                "path": path,
+                "layer": name,
+                "columns": [(column[1], column[2]) for column in columns],
+                "fid": key_columns[0][1] if len(key_columns) == 1 and key_columns[0][2].upper() == "INTEGER" else None,
+                "geom_column": geom_column,
+                "geom_type": geom_type,
+                "srid": srid,
+                "rows": db.execute(f"SELECT coalesce(max(rowid), 0) FROM {quote_ident(name)};").fetchone()[0],
+            })
+        return layers
+    finally:
+        db.close()
+
+def manifest_targets(folder):
+    """{nom de couche en minuscules: (schéma, table, clé primaire)} d'après le manifeste de
+    sauvegarde, s'il existe ; la clé vaut None si le manifeste ne l'a pas notée."""
+    path = os.path.join(folder, "backup_manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        tables = json.load(f).get("tables", {})
+    targets = {}
+    for key, entry in tables.items():
+        schema, _, table_name = key.partition(".")
+        targets[f"{schema}_{table_name}".lower()] = (schema, table_name, entry.get("cle_primaire"))
+    return targets
+
+def restore_table(task):
+    """Recharge une couche dans PostgreSQL ; exécuté dans un processus de travail.
+
+    La table est créée et remplie dans la même transaction (PostgreSQL peut alors se
+    passer du WAL avec wal_level=minimal) ; clé primaire, index spatial et ANALYZE
+    suivent le chargement. Retourne les mesures de la table.
+    """
+    layer, schema, table_name = task["layer"], task["schema"], task["table"]
+    target = f"{quote_ident(schema)}.{quote_ident(table_name)}"
+    stats = {"fichier": os.path.basename(layer["path"]), "couche": layer["layer"], "table": f"{schema}.{table_name}"}
+    # La colonne FID ajoutée par la sauvegarde n'est pas restaurée
+    columns = [column for column in layer["columns"] if column[0] != task["drop_column"]]
+    kinds = [_pg_type(declared) for _, declared in columns]
+    column_defs = []
+    geom_index = None
+    for i, (name, _) in enumerate(columns):
+        if name == layer["geom_column"]:
+            geom_index = i
+            type_modifier = f"({layer['geom_type']}, {layer['srid']})" if layer["srid"] and layer["geom_type"] != "GEOMETRY" else ""
+            column_defs.append(f"{quote_ident(name)} geometry{type_modifier}")
+        else:
+            column_defs.append(f"{quote_ident(name)} {kinds[i]}")
+
+    db = sqlite3.connect(layer["path"])
+    pg_conn = psycopg2.connect(task["dsn"])
+    try:
+        pg_conn.set_client_encoding("UTF8")
+        cur = pg_conn.cursor()
+        cur.execute(f"CREATE SCHEMA IF NOT EXISTS {quote_ident(schema)};")
+        if task["replace"]:
+            cur.execute(f"DROP TABLE IF EXISTS {target};")
+        cur.execute(f"CREATE TABLE {target} ({', '.join(column_defs)});")
+
+        start = time.perf_counter()
+        source = db.execute(
+            f"SELECT {', '.join(quote_ident(name) for name, _ in columns)} FROM {quote_ident(layer['layer'])};"
+        )
+        reader = SqliteCopyReader(source, kinds, geom_index, layer["srid"])
+        cur.copy_expert(f"COPY {target} FROM STDIN WITH (FORMAT text);", reader)
+        pg_conn.commit()
+        copy_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if task["primary_key"]:
+            cur.execute(f"ALTER TABLE {target} ADD PRIMARY KEY ({', '.join(quote_ident(name) for name in task['primary_key'])});")
+        if layer["geom_column"]:
+            cur.execute(f"CREATE INDEX ON {target} USING gist ({quote_ident(layer['geom_column'])});")
+        pg_conn.commit()
+        pg_conn.autocommit = True
+        cur.execute(f"ANALYZE {target};")
+        index_seconds = time.perf_counter() - start
+    finally:
+        pg_conn.close()
+        db.close()
+
+    stats.update({
+        "lignes": reader.rows,
+        "octets": reader.bytes,
+        "copie_s": round(copy_seconds, 3),
+        "index_s": round(index_seconds, 3),
+        "lignes_s": round(reader.rows / copy_seconds) if copy_seconds else None,
+        "mo_s": round(reader.bytes / 1e6 / copy_seconds, 2) if copy_seconds else None,
+    })
+    return stats
+
+def find_backup_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.lower().endswith((".gpkg", ".sqlite"))
+            )
+        else:
+            files.append(path)
+    return files
+
+def build_tasks(files, dsn, default_schema, replace):
+    """Une tâche par couche, des plus grosses aux plus petites (nombre de lignes)."""
+    tasks = []
+    for path in files:
+        targets = manifest_targets(os.path.dirname(os.path.abspath(path)))
+        for layer in list_layers(path):
+            schema, table_name, primary_key = targets.get(layer["layer"].lower(), (default_schema, layer["layer"], None))
+            fid = layer["fid"]
+            if primary_key is None:
+                # Sans manifeste, seule une clé qui n'a pas un nom de FID est celle d'origine
+                primary_key = [fid] if fid and not SYNTHETIC_FID_RE.match(fid) else []
+            tasks.append({
+                "layer": layer, "schema": schema, "table": table_name, "dsn": dsn, "replace": replace,
+                "primary_key": primary_key,
+                "drop_column": fid if fid and fid not in primary_key else None,
+            })
+    return sorted(tasks, key=lambda task: task["layer"]["rows"], reverse=True)
+
+def restore(tasks, workers):
+    """Restaure les couches avec `workers` processus ; retourne (mesures, erreurs)."""
+    results, errors = [], []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context) as pool:
+        futures = {pool.submit(restore_table, task): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                errors.append(f"{task['schema']}.{task['table']} : {e}")
+                print(f"[ERREUR] {task['schema']}.{task['table']} - {e}")
+                continue
+            results.append(stats)
+            print(f"[SUCCES] {stats['table']} : {stats['lignes']} lignes en {stats['copie_s']} s "
+                  f"({stats['lignes_s']} lignes/s, {stats['mo_s']} Mo/s), index et ANALYZE {stats['index_s']} s")
+    return results, errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Restaure dans PostGIS les fichiers .gpkg/.sqlite d'une sauvegarde.")
+    parser.add_argument("fichiers", nargs="+", help="Fichiers .gpkg/.sqlite ou dossiers de sauvegarde")
+    parser.add_argument("--postgres", required=True, help="Connexion libpq de la base cible (ex. \"service=sig\")")
+    parser.add_argument("--schema", default="public", help="Schéma cible des couches absentes du manifeste")
+    parser.add_argument("--processus", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Nombre de tables chargées simultanément")
+    parser.add_argument("--remplacer", action="store_true", help="Supprime les tables cibles existantes")
+    parser.add_argument("--rapport", help="Fichier JSON des mesures par table")
+    args = parser.parse_args(argv)
+
+    files = find_backup_files(args.fichiers)
+    if not files:
+        print("[ERREUR] Aucun fichier .gpkg ou .sqlite trouvé.")
+        return 2
+    tasks = build_tasks(files, args.postgres, args.schema, args.remplacer)
+    print(f"[LOG] {len(tasks)} couches à restaurer depuis {len(files)} fichiers avec {args.processus} processus")
+
+    start = time.perf_counter()
+    results, errors = restore(tasks, args.processus)
+    elapsed = time.perf_counter() - start
+    rows = sum(stats["lignes"] for stats in results)
+    megabytes = sum(stats["octets"] for stats in results) / 1e6
+    print(f"[LOG] {len(results)}/{len(tasks)} tables restaurées : {rows} lignes, {megabytes:.1f} Mo en {elapsed:.1f} s "
+          f"({rows / elapsed if elapsed else 0:.0f} lignes/s, {megabytes / elapsed if elapsed else 0:.2f} Mo/s)")
+
+    if args.rapport:
+        with open(args.rapport, "w", encoding="utf-8") as f:
+            json.dump({"duree_s": round(elapsed, 3), "tables": results, "erreurs": errors}, f, indent=2, ensure_ascii=False)
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from qgis.core import (QgsProject, QgsBookmark, QgsFeatureRequest, QgsRectangle, QgsReferencedRectangle)
+from qgis.core import (NULL, Qgis, QgsProject, QgsBookmark, QgsFeatureRequest, QgsMapLayer, QgsRectangle, QgsReferencedRectangle)
 from qgis.utils import iface
 from PyQt5.QtWidgets import (QDialog, QVBoxLayout, QComboBox, QLabel, QPushButton, QDialogButtonBox, QCheckBox, QHBoxLayout, QWidget, QScrollArea)
 from PyQt5.QtCore import Qt
@@ -47,8 +47,15 @@ class LayerFieldDialog(QDialog):
         self.buttons.accepted.connect(self.accept)
         self.buttons.rejected.connect(self.reject)
 
+        self.sync_checkbox = QCheckBox("Synchroniser : mettre à jour l'étendue des géosignets existants")
+        self.delete_stale_checkbox = QCheckBox("Supprimer les géosignets des valeurs qui n'existent plus")
+        self.delete_stale_checkbox.setEnabled(False)
+        self.sync_checkbox.toggled.connect(self.delete_stale_checkbox.setEnabled)
+
         main_layout = QVBoxLayout()
         main_layout.addWidget(scroll_area)
+        main_layout.addWidget(self.sync_checkbox)
+        main_layout.addWidget(self.delete_stale_checkbox)
         main_layout.addWidget(self.buttons)
         self.setLayout(main_layout)
 
@@ -68,47 +75,141 @@ class LayerFieldDialog(QDialog):
                 selected_layers_and_fields.append((layer, selected_field_name))
         return selected_layers_and_fields
 
+    def get_sync_options(self):
+        sync = self.sync_checkbox.isChecked()
+        return sync, sync and self.delete_stale_checkbox.isChecked()
+
+def extents_by_value(layer, field_name):
+    """Étendue des entités de `layer` pour chaque valeur du champ `field_name`.
+
+    La couche n'est parcourue qu'une fois, en ne demandant que ce champ avec la
+    géométrie ; les valeurs nulles et les entités sans géométrie sont ignorées.
+    Retourne {nom du géosignet: QgsRectangle}.
+    """
+    field_index = layer.fields().indexOf(field_name)
+    request = QgsFeatureRequest().setSubsetOfAttributes([field_index])
+    extents = {}
+    for feature in layer.getFeatures(request):
+        value = feature.attribute(field_index)
+        geometry = feature.geometry()
+        if value is None or value == NULL or geometry.isNull():
+            continue
+        box = geometry.boundingBox()
+        extent = extents.get(str(value))
+        if extent is None:
+            extents[str(value)] = QgsRectangle(box)
+        else:
+            extent.combineExtentWith(box)
+    return extents
+
+def bookmark_group(layer, field_name):
+    """Groupe des géosignets créés par la synchronisation : il délimite ceux qu'elle peut supprimer."""
+    return f"{layer.name()} - {field_name}"
+
+def same_extent(extent, other):
+    if extent.crs() != other.crs():
+        return False
+    return all(
+        abs(a - b) <= 1e-9 * max(1.0, abs(a))
+        for a, b in zip((extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()),
+                        (other.xMinimum(), other.yMinimum(), other.xMaximum(), other.yMaximum()))
+    )
+
+def sync_bookmarks(bookmark_manager, sources, delete_stale=False):
+    """Synchronise les géosignets du projet avec les étendues calculées.
+
+    `sources` est une liste de (groupe, SCR, {nom: QgsRectangle}). Les géosignets sont
+    retrouvés par (groupe, nom) dans un index construit une seule fois : ceux dont l'étendue
+    a changé sont mis à jour, un géosignet sans groupe du même nom est rattaché au groupe,
+    les valeurs nouvelles sont ajoutées dans leur groupe et, avec `delete_stale`, les
+    géosignets d'un groupe synchronisé dont la valeur a disparu sont supprimés. Les
+    géosignets des autres groupes ne sont jamais modifiés. Relancer la synchronisation
+    sans changement ne modifie rien.
+    Retourne (ajoutés, mis à jour, supprimés).
+    """
+    existing = bookmark_manager.bookmarks()
+    by_key = {}
+    for bookmark in existing:
+        by_key.setdefault((bookmark.group(), bookmark.name()), bookmark)
+
+    names_by_group = {}
+    new_bookmarks = []
+    updated_bookmarks = []
+    for group, crs, extents in sources:
+        names_by_group.setdefault(group, set()).update(extents)
+        for bookmark_name, extent in extents.items():
+            referenced_extent = QgsReferencedRectangle(extent, crs)
+            bookmark = by_key.get((group, bookmark_name))
+            if bookmark is None:
+                # Un géosignet sans groupe (créé avant la synchronisation) rejoint celui de sa couche
+                bookmark = by_key.pop(("", bookmark_name), None)
+                if bookmark is not None:
+                    bookmark.setGroup(group)
+                    bookmark.setExtent(referenced_extent)
+                    updated_bookmarks.append(bookmark)
+                else:
+                    bookmark = QgsBookmark()
+                    bookmark.setName(bookmark_name)
+                    bookmark.setGroup(group)
+                    bookmark.setExtent(referenced_extent)
+                    new_bookmarks.append(bookmark)
+                by_key[(group, bookmark_name)] = bookmark
+            elif not same_extent(bookmark.extent(), referenced_extent):
+                bookmark.setExtent(referenced_extent)
+                updated_bookmarks.append(bookmark)
+
+    stale_bookmarks = []
+    if delete_stale:
+        stale_bookmarks = [
+            bookmark for bookmark in existing
+            if bookmark.group() in names_by_group and bookmark.name() not in names_by_group[bookmark.group()]
+        ]
+
+    bookmark_manager.addBookmarks(new_bookmarks)
+    for bookmark in updated_bookmarks:
+        bookmark_manager.updateBookmark(bookmark)
+    for bookmark in stale_bookmarks:
+        bookmark_manager.removeBookmark(bookmark.id())
+    return len(new_bookmarks), len(updated_bookmarks), len(stale_bookmarks)
+
 def run_script():
     dialog = LayerFieldDialog(iface.mainWindow())
     if dialog.exec_() == QDialog.Accepted:
         selected_layers_and_fields = dialog.get_selected_layers_and_fields()
+        sync, delete_stale = dialog.get_sync_options()
+
+        bookmark_manager = QgsProject.instance().bookmarkManager()
+        if sync:
+            sources = [
+                (bookmark_group(layer, field_name), layer.crs(), extents_by_value(layer, field_name))
+                for layer, field_name in selected_layers_and_fields
+            ]
+            added, updated, deleted = sync_bookmarks(bookmark_manager, sources, delete_stale)
+            iface.messageBar().pushMessage("Succès", f"Géosignets synchronisés : {added} ajoutés, {updated} mis à jour, {deleted} supprimés.", level=Qgis.Success)
+            return
+
+        # Noms des géosignets existants, lus une seule fois
+        existing_names = {bookmark.name() for bookmark in bookmark_manager.bookmarks()}
+        new_bookmarks = []
 
         for selected_layer, selected_field_name in selected_layers_and_fields:
-            # Obtenir les valeurs uniques du champ sélectionné
-            unique_values = selected_layer.uniqueValues(selected_layer.fields().indexOf(selected_field_name))
-
-            # Créer des géosignets pour chaque valeur unique
-            for value in unique_values:
-                # Filtrer les entités par valeur unique
-                expression = f"\"{selected_field_name}\" = '{value}'"
-                request = QgsFeatureRequest().setFilterExpression(expression)
-                features = selected_layer.getFeatures(request)
-
-                # Calculer l'étendue des entités filtrées
-                extent = QgsRectangle()
-                extent.setMinimal()
-                for feature in features:
-                    extent.combineExtentWith(feature.geometry().boundingBox())
-
-                # Convertir l'étendue en QgsReferencedRectangle
-                crs = selected_layer.crs()
-                referenced_extent = QgsReferencedRectangle(extent, crs)
-
-                # Vérifier si le géosignet existe déjà
-                bookmark_name = str(value)
-                existing_bookmarks = QgsProject.instance().bookmarkManager().bookmarks()
-                if any(bookmark.name() == bookmark_name for bookmark in existing_bookmarks):
+            # Étendue de chaque valeur unique du champ sélectionné, en une lecture de la couche
+            crs = selected_layer.crs()
+            for bookmark_name, extent in extents_by_value(selected_layer, selected_field_name).items():
+                # Ne pas recréer un géosignet existant
+                if bookmark_name in existing_names:
                     continue
+                existing_names.add(bookmark_name)
 
-                # Créer un géosignet
                 bookmark = QgsBookmark()
                 bookmark.setName(bookmark_name)
-                bookmark.setExtent(referenced_extent)
+                bookmark.setExtent(QgsReferencedRectangle(extent, crs))
+                new_bookmarks.append(bookmark)
 
-                # Ajouter le géosignet au projet
-                QgsProject.instance().bookmarkManager().addBookmark(bookmark)
+        # Ajouter tous les géosignets au projet en une fois
+        bookmark_manager.addBookmarks(new_bookmarks)
 
-        iface.messageBar().pushMessage("Succès", "Géosignets créés pour chaque valeur unique dans les champs sélectionnés des couches sélectionnées.", level=Qgis.Success)
+        iface.messageBar().pushMessage("Succès", f"{len(new_bookmarks)} géosignets créés pour les valeurs uniques des champs sélectionnés des couches sélectionnées.", level=Qgis.Success)
 
 # Exécuter le script
 run_script()
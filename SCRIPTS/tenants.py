@@ -1,14 +1,846 @@
+"""Attribution de tenants aux blocs de récolte.
+
+Trois points d'entrée partagent le même moteur (compute_tenants) :
+- console Python de QGIS : boîte de dialogue TenantProcessorDialog ;
+- Processing : algorithme `script:tenants` (copier ce fichier dans le dossier des scripts),
+  utilisable sans interface via `qgis_process run script:tenants -- INPUT=... NAME_FIELD=... OUTPUT=...` ;
+- ligne de commande : `python tenants.py blocs.gpkg --champ-nom nom_bloc --sortie dossier/`.
+
+Pour une couche PostGIS, le regroupement est fait dans la base (ST_ClusterDBSCAN).
+"""
 from qgis.core import (
-    QgsProject, QgsVectorLayer, QgsField, QgsFeature, QgsGeometry,
-    QgsExpression, QgsFeatureRequest, QgsCategorizedSymbolRenderer,
-    QgsSymbol, QgsRendererCategory, QgsFillSymbol
+    QgsApplication, QgsCoordinateTransformContext, QgsProject, QgsVectorLayer, QgsField, QgsFields,
+    QgsFeature, QgsGeometry, QgsExpression, QgsExpressionContext, QgsExpressionContextUtils,
+    QgsFeatureRequest, QgsCategorizedSymbolRenderer, QgsSymbol, QgsRendererCategory, QgsFillSymbol,
+    QgsSpatialIndex, QgsVectorFileWriter, QgsFeatureSink, QgsProcessing, QgsProcessingAlgorithm,
+    QgsProcessingException, QgsProcessingParameterFeatureSource, QgsProcessingParameterField,
+    QgsProcessingParameterDistance, QgsProcessingParameterExpression, QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterNumber, QgsProcessingFeatureSourceDefinition, QgsDataSourceUri,
+    QgsProviderRegistry, QgsProviderConnectionException, NULL
 )
 from PyQt5.QtCore import QVariant, Qt
 from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import (
     QDialog, QVBoxLayout, QLabel, QComboBox, QListWidget, QListWidgetItem,
-    QPushButton, QMessageBox, QLineEdit, QSpinBox
+    QPushButton, QMessageBox, QLineEdit, QSpinBox, QCheckBox
+)
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import inspect
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+class NeighbourSearch:
+    """Recherche des blocs voisins à l'aide d'un index spatial.
+
+    Les rectangles englobants sont tamponnés de la distance choisie pour obtenir
+    les candidats depuis un QgsSpatialIndex ; le calcul exact de distance (GEOS)
+    n'est fait que sur ces candidats.
+    """
+
+    def __init__(self, distance):
+        self.distance = distance
+        self.index = QgsSpatialIndex()
+        self.geometries = {}
+        self.bboxes = {}
+        self.distance_calls = 0
+
+    def add(self, fid, geom, bbox=None):
+        self.geometries[fid] = geom
+        self.bboxes[fid] = bbox if bbox is not None else geom.boundingBox()
+        self.index.addFeature(fid, self.bboxes[fid])
+
+    def candidates(self, fid):
+        search_rect = self.bboxes[fid].buffered(self.distance)
+        return [other for other in self.index.intersects(search_rect) if other != fid]
+
+    def remove(self, fid):
+        feature = QgsFeature(fid)
+        feature.setGeometry(QgsGeometry.fromRect(self.bboxes.pop(fid)))
+        self.index.deleteFeature(feature)
+        del self.geometries[fid]
+
+    def pairs(self, fids=None):
+        """Paires (a, b), a < b, de blocs à moins de la distance ; chaque paire n'est testée qu'une fois.
+
+        Avec `fids`, seules les paires entre ces blocs sont retournées.
+        """
+        subset = self.geometries if fids is None else set(fids)
+        for fid in subset:
+            geom = self.geometries[fid]
+            for other in self.candidates(fid):
+                if other > fid and other in subset:
+                    self.distance_calls += 1
+                    if geom.distance(self.geometries[other]) <= self.distance:
+                        yield fid, other
+
+    def neighbours(self, fid):
+        geom = self.geometries[fid]
+        result = []
+        for other in self.candidates(fid):
+            self.distance_calls += 1
+            if geom.distance(self.geometries[other]) <= self.distance:
+                result.append(other)
+        return result
+
+
+class BlocRecord:
+    """Enregistrement compact d'un bloc valide : superficie et emprise calculées une seule fois."""
+
+    __slots__ = ('fid', 'name', 'geometry', 'bbox', 'area', 'attributes')
+
+    def __init__(self, fid, name, geometry, attributes=()):
+        self.fid = fid
+        self.name = name
+        self.geometry = geometry
+        self.bbox = geometry.boundingBox()
+        self.area = geometry.area() / 10000  # Convertir en hectares
+        self.attributes = attributes
+
+
+def read_blocs(features, name_field, additional_fields=(), log=print):
+    """Parcourt les entités une seule fois et produit un BlocRecord par géométrie valide."""
+    for feature in features:
+        geom = feature.geometry()
+        if not geom or geom.isNull() or not geom.isGeosValid():
+            log(f"Géométrie invalide pour l'entité ID: {feature.id()}")
+            continue
+        yield BlocRecord(feature.id(), feature[name_field], geom,
+                         tuple(feature[field_name] for field_name in additional_fields))
+
+
+def find_pairs(blocs, distance):
+    """Retourne (ids, paires de blocs à moins de `distance`, nombre de calculs de distance)."""
+    search = NeighbourSearch(distance)
+    for bloc in blocs:
+        search.add(bloc.fid, bloc.geometry, bloc.bbox)
+    pairs = list(search.pairs())
+    return list(search.geometries), pairs, search.distance_calls
+
+
+class DisjointSet:
+    """Ensembles disjoints (union-find) avec compression de chemin et union par taille."""
+
+    def __init__(self, items=()):
+        self.parent = {}
+        self.size = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.size[item] = 1
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Compression de chemin : chaque nœud parcouru pointe directement vers la racine
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return root_a
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return root_a
+
+    def groups(self):
+        groups = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return list(groups.values())
+
+
+def cluster_tenants(fids, pairs):
+    """Regroupe les blocs en tenants, c.-à-d. en composantes connexes du graphe des paires.
+
+    Les tenants sont numérotés à partir de 1 selon le plus petit identifiant de
+    leurs blocs : une même entrée donne toujours les mêmes numéros.
+    """
+    components = DisjointSet(fids)
+    for a, b in pairs:
+        components.union(a, b)
+
+    tenant_dict = {}
+    for tenant, members in enumerate(sorted(components.groups(), key=min), start=1):
+        for fid in members:
+            tenant_dict[fid] = tenant
+    return tenant_dict
+
+
+def _tile_components(task):
+    """Travail d'un processus : composantes locales (2 blocs et plus) des blocs d'une tuile."""
+    blocks, distance = task
+    search = NeighbourSearch(distance)
+    for fid, wkb in blocks:
+        geom = QgsGeometry()
+        geom.fromWkb(wkb)
+        search.add(fid, geom)
+    components = DisjointSet(search.geometries)
+    for a, b in search.pairs():
+        components.union(a, b)
+    return [group for group in components.groups() if len(group) > 1], search.distance_calls
+
+
+def _engine_module():
+    """Module importable par les processus de travail.
+
+    Les fonctions définies par la console QGIS (ou par `python tenants.py`) ne sont
+    pas importables par nom dans un processus enfant : on passe par `import tenants`.
+    """
+    # Le chargeur de Processing passe par importlib sans enregistrer le module dans sys.modules
+    module = sys.modules.get(__name__)
+    if __name__ == "tenants" and getattr(module, "_engine_module", None) is _engine_module:
+        return module
+    try:
+        module_dirs = [os.path.dirname(os.path.abspath(__file__))]
+    except NameError:
+        # La console QGIS exécute le fichier par exec(), sans __file__
+        source = inspect.getsourcefile(_engine_module)
+        module_dirs = [os.path.dirname(os.path.abspath(source))] if source and os.path.exists(source) else []
+        try:
+            from processing.script import ScriptUtils
+            module_dirs += ScriptUtils.scriptsFolders()
+        except ImportError:
+            pass
+    for module_dir in module_dirs:
+        if os.path.exists(os.path.join(module_dir, "tenants.py")):
+            if module_dir not in sys.path:
+                sys.path.insert(0, module_dir)
+            break
+    try:
+        import tenants
+    except ImportError:
+        raise RuntimeError("tenants.py introuvable : placer son dossier dans sys.path pour utiliser plusieurs processus")
+    return tenants
+
+
+def _python_executable():
+    """Interpréteur Python des processus de travail.
+
+    Dans QGIS, sys.executable est le binaire de QGIS (qgis-bin.exe, QGIS.app, qgis) :
+    les processus « spawn » relanceraient QGIS au lieu de Python.
+    """
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    if os.name == "nt":
+        candidates = [os.path.join(sys.exec_prefix, "pythonw.exe"), os.path.join(sys.exec_prefix, "python.exe")]
+    else:
+        version = f"{sys.version_info.major}.{sys.version_info.minor}"
+        candidates = [os.path.join(sys.exec_prefix, "bin", f"python{version}"),
+                      os.path.join(sys.exec_prefix, "bin", "python3"),
+                      shutil.which(f"python{version}"), shutil.which("python3")]
+    for candidate in candidates:
+        if candidate and os.path.exists(candidate):
+            return candidate
+    raise RuntimeError("interpréteur Python introuvable pour les processus de travail")
+
+
+def _process_pool(workers):
+    """Pool de processus « spawn » lancés avec l'interpréteur Python, même depuis QGIS."""
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(_python_executable())
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+def tile_blocks(blocs, distance, tile_count):
+    """Répartit les blocs sur une grille de tuiles qui se chevauchent de `distance`.
+
+    Un bloc appartient à chaque tuile dont l'emprise tamponnée de `distance` touche
+    son rectangle englobant : deux blocs à moins de `distance` partagent donc au
+    moins une tuile, celle qui contient le point du premier le plus proche du second.
+    """
+    bboxes = {bloc.fid: bloc.bbox for bloc in blocs}
+    x_min = min(bbox.xMinimum() for bbox in bboxes.values())
+    y_min = min(bbox.yMinimum() for bbox in bboxes.values())
+    x_max = max(bbox.xMaximum() for bbox in bboxes.values())
+    y_max = max(bbox.yMaximum() for bbox in bboxes.values())
+    # Tuiles carrées, jamais plus petites que quelques fois la distance (sinon le chevauchement domine)
+    tile_size = max((x_max - x_min) / tile_count, (y_max - y_min) / tile_count, distance * 10, 1.0)
+    columns = int((x_max - x_min) // tile_size) + 1
+    rows = int((y_max - y_min) // tile_size) + 1
+
+    tiles = {}
+    for fid, bbox in bboxes.items():
+        first_col = max(int((bbox.xMinimum() - distance - x_min) // tile_size), 0)
+        last_col = min(int((bbox.xMaximum() + distance - x_min) // tile_size), columns - 1)
+        first_row = max(int((bbox.yMinimum() - distance - y_min) // tile_size), 0)
+        last_row = min(int((bbox.yMaximum() + distance - y_min) // tile_size), rows - 1)
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                tiles.setdefault((col, row), []).append(fid)
+    return [tiles[key] for key in sorted(tiles)]
+
+
+def find_pairs_parallel(blocs, distance, workers):
+    """Équivalent parallèle de find_pairs.
+
+    Les composantes locales de chaque tuile sont calculées dans un pool de
+    processus ; les paires retournées relient les membres de chaque composante
+    locale, de sorte que cluster_tenants fusionne les composantes qui traversent
+    les coutures entre tuiles. Le résultat est identique au calcul séquentiel.
+    """
+    if not blocs:
+        return [], 0
+    wkbs = {bloc.fid: bytes(bloc.geometry.asWkb()) for bloc in blocs}
+    tiles = tile_blocks(blocs, distance, math.ceil(math.sqrt(workers * 4)))
+    tasks = [([(fid, wkbs[fid]) for fid in tile], distance) for tile in tiles]
+
+    pairs = []
+    distance_calls = 0
+    with _process_pool(workers) as pool:
+        for groups, calls in pool.map(_engine_module()._tile_components, tasks):
+            distance_calls += calls
+            for group in groups:
+                pairs.extend((group[0], other) for other in group[1:])
+    return pairs, distance_calls
+
+
+def assign_tenants(blocs, distance, workers=1):
+    """Retourne ({id: tenant}, nombre de calculs de distance) ; `workers` > 1 active le calcul par tuiles."""
+    if workers > 1:
+        fids = [bloc.fid for bloc in blocs]
+        pairs, distance_calls = find_pairs_parallel(blocs, distance, workers)
+    else:
+        fids, pairs, distance_calls = find_pairs(blocs, distance)
+    return cluster_tenants(fids, pairs), distance_calls
+
+
+TENANT_FIELDS = [
+    ('tenant', QVariant.Int),
+    ('blocs_partages', QVariant.String),
+    ('id_original', QVariant.Int),
+    ('superficie_bloc', QVariant.Double),
+    ('superficie_tenant', QVariant.Double),
+    ('pourcentage_superficie', QVariant.Double)
+]
+
+
+OUTPUT_BATCH_SIZE = 5000
+
+
+TenantRecord = namedtuple('TenantRecord', [name for name, _ in TENANT_FIELDS] + ['geometry', 'attributes'])
+
+
+def filter_request(expression, fields=None, attributes=None):
+    """Requête filtrant les entités selon `expression` ; ValueError si l'expression est invalide.
+
+    Si `attributes` est donné, seuls ces champs sont lus (les champs utilisés par
+    l'expression restent disponibles pour le filtre).
+    """
+    request = QgsFeatureRequest()
+    if expression:
+        expr = QgsExpression(expression)
+        if expr.hasParserError():
+            raise ValueError(f"Erreur dans l'expression : {expr.parserErrorString()}")
+        request = QgsFeatureRequest(expr)
+    if attributes is not None:
+        request.setSubsetOfAttributes(list(attributes), fields)
+    return request
+
+
+def compute_tenants(features, name_field, distance, additional_fields=(), log=print, workers=1):
+    """Calcule les tenants d'un itérable de QgsFeature, sans interface graphique.
+
+    Les entités ne sont parcourues qu'une fois et réduites à des BlocRecord.
+    Retourne un TenantRecord par bloc valide : les valeurs des champs de
+    TENANT_FIELDS, la géométrie et les valeurs des `additional_fields`. Avec
+    `workers` > 1, le voisinage est calculé par tuiles dans autant de processus.
+    """
+    blocs = list(read_blocs(features, name_field, additional_fields, log))
+
+    # Tenants = composantes connexes des blocs à moins de la distance (index spatial + union-find)
+    start = time.perf_counter()
+    tenant_dict, distance_calls = assign_tenants(blocs, distance, workers)
+    log(f"Calcul des tenants : {len(tenant_dict)} blocs, {distance_calls} calculs de distance, "
+        f"{workers} processus, {time.perf_counter() - start:.2f} s")
+
+    # Superficies et noms de blocs agrégés une seule fois par tenant
+    tenant_blocs = {}
+    tenant_areas = {}
+    for bloc in blocs:
+        tenant = tenant_dict[bloc.fid]
+        tenant_blocs.setdefault(tenant, set()).add(str(bloc.name))
+        tenant_areas[tenant] = tenant_areas.get(tenant, 0) + bloc.area
+    blocs_partages_by_tenant = {tenant: ', '.join(sorted(names)) for tenant, names in tenant_blocs.items()}
+
+    records = []
+    for bloc in blocs:
+        tenant = tenant_dict[bloc.fid]
+        tenant_area = tenant_areas[tenant]
+        records.append(TenantRecord(
+            tenant=tenant,
+            blocs_partages=blocs_partages_by_tenant[tenant],
+            id_original=bloc.fid,
+            superficie_bloc=bloc.area,
+            superficie_tenant=tenant_area,
+            pourcentage_superficie=(bloc.area / tenant_area) * 100 if tenant_area > 0 else 0,
+            geometry=bloc.geometry,
+            attributes=bloc.attributes
+        ))
+    return records
+
+
+POSTGIS_TENANTS_SQL = """
+WITH blocs AS (
+    SELECT {key} AS fid,
+           COALESCE({name}::text, 'NULL') AS nom,
+           ST_Area({geom}) / 10000 AS superficie,
+           ST_ClusterDBSCAN({geom}, eps := {distance}, minpoints := 1) OVER () AS grappe
+    FROM {table}
+    WHERE {conditions}
+), grappes AS (
+    SELECT grappe,
+           MIN(fid) AS premier,
+           SUM(superficie) AS superficie_tenant,
+           string_agg(DISTINCT nom COLLATE "C", ', ' ORDER BY nom COLLATE "C") AS blocs_partages
+    FROM blocs
+    GROUP BY grappe
 )
+SELECT b.fid, DENSE_RANK() OVER (ORDER BY g.premier) AS tenant, g.blocs_partages,
+       b.superficie, g.superficie_tenant
+FROM blocs b JOIN grappes g USING (grappe)
+"""
+
+
+def _quoted_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def postgis_tenants(layer, name_field, distance, additional_fields=(), expression="", log=print):
+    """Calcule les tenants dans PostGIS pour une couche du fournisseur `postgres`.
+
+    Numéros de tenants, superficies et blocs partagés sont calculés par une seule
+    requête (ST_ClusterDBSCAN avec minpoints := 1, soit les composantes connexes
+    des blocs à moins de `distance`) ; seuls ces résultats, puis les géométries et
+    champs conservés, reviennent dans Python. Les numéros sont les mêmes qu'avec le
+    moteur local. Retourne None si la couche ne se prête pas au calcul dans la base.
+    """
+    if layer.providerType() != "postgres":
+        return None
+    uri = QgsDataSourceUri(layer.source())
+    key_index = layer.fields().indexOf(uri.keyColumn())
+    if key_index < 0 or layer.fields().at(key_index).type() not in (QVariant.Int, QVariant.LongLong):
+        log("PostGIS : une clé primaire entière simple est requise.")
+        return None
+    if not uri.geometryColumn():
+        log("PostGIS : la couche n'a pas de colonne géométrique.")
+        return None
+
+    geom = _quoted_identifier(uri.geometryColumn())
+    key = _quoted_identifier(uri.keyColumn())
+    conditions = [f"{geom} IS NOT NULL", f"ST_IsValid({geom})"]
+    if layer.subsetString():
+        conditions.append(f"({layer.subsetString()})")
+    if expression:
+        # L'expression QGIS est évaluée sans géométrie ; seule la liste des identifiants part vers la base
+        request = filter_request(expression, layer.fields(), []).setFlags(QgsFeatureRequest.NoGeometry)
+        fids = [feature.id() for feature in layer.getFeatures(request)]
+        if not fids:
+            return []
+        conditions.append(f"{key} = ANY(ARRAY[{','.join(map(str, fids))}]::bigint[])")
+    sql = POSTGIS_TENANTS_SQL.format(
+        key=key,
+        name=_quoted_identifier(name_field),
+        geom=geom,
+        distance=float(distance),
+        table=uri.quotedTablename(),
+        conditions=" AND ".join(conditions)
+    )
+
+    start = time.perf_counter()
+    try:
+        connection = QgsProviderRegistry.instance().providerMetadata('postgres').createConnection(layer.source(), {})
+        results = {row[0]: row[1:] for row in connection.executeSql(sql)}
+    except QgsProviderConnectionException as e:
+        log(f"PostGIS : {e}")
+        return None
+    log(f"Calcul des tenants dans PostGIS : {len(results)} blocs, {time.perf_counter() - start:.2f} s")
+
+    records = []
+    request = filter_request(expression, layer.fields(), [name_field] + list(additional_fields))
+    for feature in layer.getFeatures(request):
+        result = results.get(feature.id())
+        if result is None:
+            log(f"Géométrie invalide pour l'entité ID: {feature.id()}")
+            continue
+        tenant, blocs_partages, bloc_area, tenant_area = result
+        records.append(TenantRecord(
+            tenant=tenant,
+            blocs_partages=blocs_partages,
+            id_original=feature.id(),
+            superficie_bloc=bloc_area,
+            superficie_tenant=tenant_area,
+            pourcentage_superficie=(bloc_area / tenant_area) * 100 if tenant_area > 0 else 0,
+            geometry=feature.geometry(),
+            attributes=tuple(feature[field_name] for field_name in additional_fields)
+        ))
+    return records
+
+
+def compute_layer_tenants(layer, name_field, distance, additional_fields=(), expression="", log=print,
+                          workers=1):
+    """Calcule les tenants d'une couche : dans la base pour PostGIS, sinon avec le moteur local."""
+    if layer.providerType() == "postgres":
+        records = postgis_tenants(layer, name_field, distance, additional_fields, expression, log)
+        if records is not None:
+            return records
+        log("Repli sur le calcul local des tenants.")
+    request = filter_request(expression, layer.fields(), [name_field] + list(additional_fields))
+    return compute_tenants(layer.getFeatures(request), name_field, distance, additional_fields, log, workers)
+
+
+def tenant_fields(source_fields, additional_fields=()):
+    """Champs de la couche de sortie : TENANT_FIELDS puis les champs conservés de la couche source."""
+    fields = QgsFields()
+    for name, field_type in TENANT_FIELDS:
+        fields.append(QgsField(name, field_type))
+    for field_name in additional_fields:
+        field = source_fields.field(field_name)
+        fields.append(QgsField(field.name(), field.type()))
+    return fields
+
+
+def tenant_features(records, fields):
+    """Convertit les TenantRecord de compute_tenants en QgsFeature selon `fields`."""
+    for record in records:
+        feature = QgsFeature(fields)
+        feature.setGeometry(record.geometry)
+        feature.setAttributes([
+            value if value is not None else NULL
+            for value in record[:len(TENANT_FIELDS)] + record.attributes
+        ])
+        yield feature
+
+
+def _add_features(sink, features):
+    # QgsVectorDataProvider.addFeatures retourne (succès, entités), les puits un booléen
+    result = sink.addFeatures(features, QgsFeatureSink.FastInsert)
+    return result[0] if isinstance(result, tuple) else result
+
+
+def write_tenant_features(sink, records, fields, batch_size=OUTPUT_BATCH_SIZE):
+    """Écrit les tenants dans `sink` (fournisseur, puits Processing, QgsVectorFileWriter) par lots."""
+    batch = []
+    for feature in tenant_features(records, fields):
+        batch.append(feature)
+        if len(batch) >= batch_size:
+            if not _add_features(sink, batch):
+                return False
+            batch = []
+    return not batch or _add_features(sink, batch)
+
+
+def create_tenant_layer(records, fields, crs, name="Tenants"):
+    """Crée la couche mémoire des tenants, avec une symbologie catégorisée par tenant.
+
+    Lève RuntimeError si le fournisseur refuse une partie des entités.
+    """
+    mem_layer = QgsVectorLayer("Polygon", name, "memory")
+    mem_layer.setCrs(crs)
+    provider = mem_layer.dataProvider()
+    provider.addAttributes(fields.toList())
+    mem_layer.updateFields()
+    if not write_tenant_features(provider, records, mem_layer.fields()):
+        raise RuntimeError(f"Écriture de la couche {name} incomplète : {'; '.join(provider.errors())}")
+    mem_layer.updateExtents()
+
+    # Créer des catégories avec des couleurs distinctes
+    categories = [
+        tenant_category(tenant_id, mem_layer.geometryType())
+        for tenant_id in sorted({record.tenant for record in records})
+    ]
+    mem_layer.setRenderer(QgsCategorizedSymbolRenderer('tenant', categories))
+    return mem_layer
+
+
+def tenant_category(tenant_id, geometry_type):
+    colors = ['#ff0000', '#00ff00', '#0000ff', '#ffff00', '#ff00ff', '#00ffff']
+    symbol = QgsSymbol.defaultSymbol(geometry_type)
+    symbol.setColor(QColor(colors[tenant_id % len(colors)]))
+    return QgsRendererCategory(str(tenant_id), symbol, str(tenant_id))
+
+
+class TenantsAlgorithm(QgsProcessingAlgorithm):
+    """Algorithme Processing : même calcul que la boîte de dialogue, utilisable par qgis_process."""
+
+    INPUT = 'INPUT'
+    NAME_FIELD = 'NAME_FIELD'
+    DISTANCE = 'DISTANCE'
+    FIELDS = 'FIELDS'
+    EXPRESSION = 'EXPRESSION'
+    WORKERS = 'WORKERS'
+    OUTPUT = 'OUTPUT'
+
+    def name(self):
+        return 'tenants'
+
+    def displayName(self):
+        return 'Attribuer des tenants'
+
+    def group(self):
+        return 'Récolte'
+
+    def groupId(self):
+        return 'recolte'
+
+    def shortHelpString(self):
+        return ("Regroupe les blocs de récolte situés à moins de la distance choisie en tenants "
+                "et calcule la superficie de chaque tenant.")
+
+    def createInstance(self):
+        return TenantsAlgorithm()
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(QgsProcessingParameterFeatureSource(
+            self.INPUT, 'Couche des blocs de récolte', [QgsProcessing.TypeVectorPolygon]))
+        self.addParameter(QgsProcessingParameterField(
+            self.NAME_FIELD, 'Champ contenant le nom du bloc', parentLayerParameterName=self.INPUT))
+        self.addParameter(QgsProcessingParameterDistance(
+            self.DISTANCE, 'Distance pour le calcul des tenants', 60, self.INPUT, minValue=0))
+        self.addParameter(QgsProcessingParameterField(
+            self.FIELDS, 'Champs à conserver', parentLayerParameterName=self.INPUT,
+            allowMultiple=True, optional=True))
+        self.addParameter(QgsProcessingParameterExpression(
+            self.EXPRESSION, 'Expression de filtrage', parentLayerParameterName=self.INPUT, optional=True))
+        self.addParameter(QgsProcessingParameterNumber(
+            self.WORKERS, 'Nombre de processus', QgsProcessingParameterNumber.Integer, 1, minValue=1))
+        self.addParameter(QgsProcessingParameterFeatureSink(
+            self.OUTPUT, 'Tenants', QgsProcessing.TypeVectorPolygon))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        if source is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.INPUT))
+        name_field = self.parameterAsString(parameters, self.NAME_FIELD, context)
+        distance = self.parameterAsDouble(parameters, self.DISTANCE, context)
+        additional_fields = self.parameterAsFields(parameters, self.FIELDS, context)
+        expression = self.parameterAsExpression(parameters, self.EXPRESSION, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+
+        # Couche PostGIS entière (pas seulement la sélection) : calcul dans la base
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        definition = parameters[self.INPUT]
+        selected_only = isinstance(definition, QgsProcessingFeatureSourceDefinition) and definition.selectedFeaturesOnly
+        try:
+            if layer is not None and not selected_only:
+                records = compute_layer_tenants(layer, name_field, distance, additional_fields, expression,
+                                                log=feedback.pushInfo, workers=workers)
+            else:
+                request = filter_request(expression, source.fields(), [name_field] + additional_fields)
+                records = compute_tenants(source.getFeatures(request), name_field, distance,
+                                          additional_fields, log=feedback.pushInfo, workers=workers)
+        except ValueError as e:
+            raise QgsProcessingException(str(e))
+
+        fields = tenant_fields(source.fields(), additional_fields)
+        sink, dest_id = self.parameterAsSink(parameters, self.OUTPUT, context, fields,
+                                             source.wkbType(), source.sourceCrs())
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+        if not write_tenant_features(sink, records, fields):
+            raise QgsProcessingException(self.writeFeatureError(sink, parameters, self.OUTPUT))
+        return {self.OUTPUT: dest_id}
+
+
+class LiveTenants:
+    """Mode en direct : tient une couche Tenants à jour lors des modifications de la couche source.
+
+    À chaque enregistrement de modifications (ajout, suppression, géométrie ou
+    attributs), seuls les tenants touchés par les blocs modifiés et par leur
+    voisinage tamponné de la distance sont recalculés, et la couche Tenants est
+    modifiée sur place. Les tenants recalculés conservent leurs numéros ; un
+    tenant scindé reçoit un nouveau numéro pour chaque nouvelle partie.
+    """
+
+    def __init__(self, source_layer, tenant_layer, name_field, distance, additional_fields=(),
+                 expression="", log=print):
+        self.source_layer = source_layer
+        self.tenant_layer = tenant_layer
+        self.name_field = name_field
+        self.additional_fields = list(additional_fields)
+        self.expression = QgsExpression(expression) if expression else None
+        self.log = log
+
+        self.blocs = {}
+        self.search = NeighbourSearch(distance)
+        request = filter_request(expression, source_layer.fields(), [name_field] + self.additional_fields)
+        for bloc in read_blocs(source_layer.getFeatures(request), name_field, self.additional_fields, log):
+            self.blocs[bloc.fid] = bloc
+            self.search.add(bloc.fid, bloc.geometry, bloc.bbox)
+
+        # Tenants actuels, lus depuis la couche Tenants
+        self.output_ids = {}
+        self.tenant_of = {}
+        self.members = {}
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(['id_original', 'tenant'], tenant_layer.fields())
+        for feature in tenant_layer.getFeatures(request):
+            fid, tenant = feature['id_original'], feature['tenant']
+            self.output_ids[fid] = feature.id()
+            self.tenant_of[fid] = tenant
+            self.members.setdefault(tenant, set()).add(fid)
+        self.next_tenant = max(self.members, default=0) + 1
+
+        source_layer.committedFeaturesAdded.connect(self._on_features_added)
+        source_layer.committedFeaturesRemoved.connect(self._on_features_removed)
+        source_layer.committedGeometriesChanges.connect(self._on_geometries_changed)
+        source_layer.committedAttributeValuesChanges.connect(self._on_attributes_changed)
+        tenant_layer.willBeDeleted.connect(self.stop)
+
+    def stop(self):
+        for signal, slot in [
+            (self.source_layer.committedFeaturesAdded, self._on_features_added),
+            (self.source_layer.committedFeaturesRemoved, self._on_features_removed),
+            (self.source_layer.committedGeometriesChanges, self._on_geometries_changed),
+            (self.source_layer.committedAttributeValuesChanges, self._on_attributes_changed),
+        ]:
+            try:
+                signal.disconnect(slot)
+            except TypeError:
+                pass
+        if self in _live_sessions:
+            _live_sessions.remove(self)
+
+    def _on_features_added(self, layer_id, features):
+        self.update(feature.id() for feature in features)
+
+    def _on_features_removed(self, layer_id, fids):
+        self.update(fids)
+
+    def _on_geometries_changed(self, layer_id, geometries):
+        self.update(geometries.keys())
+
+    def _on_attributes_changed(self, layer_id, attributes):
+        self.update(attributes.keys())
+
+    def _changed_features(self, fids):
+        """Entités modifiées qui respectent encore l'expression de filtrage."""
+        context = QgsExpressionContext(QgsExpressionContextUtils.globalProjectLayerScopes(self.source_layer))
+        for feature in self.source_layer.getFeatures(QgsFeatureRequest().setFilterFids(list(fids))):
+            if self.expression is not None:
+                context.setFeature(feature)
+                if not self.expression.evaluate(context):
+                    continue
+            yield feature
+
+    def update(self, fids):
+        """Recalcule les tenants touchés par les blocs `fids` et met à jour la couche Tenants."""
+        start = time.perf_counter()
+        fids = set(fids)
+        calls_before = self.search.distance_calls
+
+        # Retirer l'ancienne version des blocs modifiés, puis relire la nouvelle
+        affected = {self.tenant_of[fid] for fid in fids if fid in self.tenant_of}
+        for fid in fids & set(self.blocs):
+            self.search.remove(fid)
+            del self.blocs[fid]
+        for bloc in read_blocs(self._changed_features(fids), self.name_field, self.additional_fields, self.log):
+            self.blocs[bloc.fid] = bloc
+            self.search.add(bloc.fid, bloc.geometry, bloc.bbox)
+        present = fids & set(self.blocs)
+        for fid in present:
+            affected.update(self.tenant_of[other] for other in self.search.neighbours(fid) if other in self.tenant_of)
+
+        # Les blocs des tenants touchés forment un ensemble fermé pour la relation de voisinage
+        members = set(present)
+        for tenant in affected:
+            members.update(fid for fid in self.members.pop(tenant) if fid in self.blocs)
+        components = DisjointSet(members)
+        for a, b in self.search.pairs(members):
+            components.union(a, b)
+
+        # Chaque composante reprend le plus petit numéro libre parmi ceux de ses blocs
+        free_ids = set(affected)
+        new_tenants = {}
+        for group in sorted(components.groups(), key=min):
+            previous = sorted({self.tenant_of[fid] for fid in group if fid in self.tenant_of} & free_ids)
+            if previous:
+                tenant = previous[0]
+                free_ids.discard(tenant)
+            else:
+                tenant = self.next_tenant
+                self.next_tenant += 1
+            new_tenants[tenant] = group
+        for fid in fids - present:
+            self.tenant_of.pop(fid, None)
+        for tenant, group in new_tenants.items():
+            self.members[tenant] = set(group)
+            for fid in group:
+                self.tenant_of[fid] = tenant
+
+        self._write(fids, present, new_tenants)
+        self.log(f"Tenants mis à jour : {len(fids)} bloc(s) modifié(s), {len(members)} bloc(s) recalculé(s), "
+                 f"{self.search.distance_calls - calls_before} calculs de distance, "
+                 f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def _write(self, fids, present, new_tenants):
+        provider = self.tenant_layer.dataProvider()
+        fields = self.tenant_layer.fields()
+        indexes = [fields.indexOf(name) for name, _ in TENANT_FIELDS]
+        indexes += [fields.indexOf(field_name) for field_name in self.additional_fields]
+
+        removed = [self.output_ids.pop(fid) for fid in fids - present if fid in self.output_ids]
+        if removed:
+            provider.deleteFeatures(removed)
+
+        records = {}
+        for tenant, group in new_tenants.items():
+            tenant_area = sum(self.blocs[fid].area for fid in group)
+            blocs_partages = ', '.join(sorted({str(self.blocs[fid].name) for fid in group}))
+            for fid in group:
+                bloc = self.blocs[fid]
+                records[fid] = TenantRecord(
+                    tenant=tenant,
+                    blocs_partages=blocs_partages,
+                    id_original=fid,
+                    superficie_bloc=bloc.area,
+                    superficie_tenant=tenant_area,
+                    pourcentage_superficie=(bloc.area / tenant_area) * 100 if tenant_area > 0 else 0,
+                    geometry=bloc.geometry,
+                    attributes=bloc.attributes
+                )
+
+        added = [fid for fid in present if fid not in self.output_ids]
+        if added:
+            ok, features = provider.addFeatures(list(tenant_features([records[fid] for fid in added], fields)))
+            for fid, feature in zip(added, features):
+                self.output_ids[fid] = feature.id()
+        changed_geometries = {self.output_ids[fid]: self.blocs[fid].geometry for fid in present if fid not in added}
+        if changed_geometries:
+            provider.changeGeometryValues(changed_geometries)
+        provider.changeAttributeValues({
+            self.output_ids[fid]: {
+                index: value if value is not None else NULL
+                for index, value in zip(indexes, record[:len(TENANT_FIELDS)] + record.attributes)
+            }
+            for fid, record in records.items() if fid not in added
+        })
+
+        renderer = self.tenant_layer.renderer()
+        if isinstance(renderer, QgsCategorizedSymbolRenderer):
+            for tenant in new_tenants:
+                if renderer.categoryIndexForValue(str(tenant)) < 0:
+                    renderer.addCategory(tenant_category(tenant, self.tenant_layer.geometryType()))
+        self.tenant_layer.updateExtents()
+        self.tenant_layer.triggerRepaint()
+
+
+# Sessions du mode en direct (gardées ici pour ne pas être détruites avec la boîte de dialogue)
+_live_sessions = []
+
 
 class TenantProcessorDialog(QDialog):
     def __init__(self, layers):
@@ -54,6 +886,19 @@ class TenantProcessorDialog(QDialog):
         self.distance_spinbox.setValue(60)  # Valeur par défaut
         self.layout().addWidget(self.distance_spinbox)
 
+        # Nombre de processus pour les grandes couches (calcul par tuiles)
+        self.workers_label = QLabel("Nombre de processus (1 = calcul séquentiel):")
+        self.layout().addWidget(self.workers_label)
+        self.workers_spinbox = QSpinBox()
+        self.workers_spinbox.setMinimum(1)
+        self.workers_spinbox.setMaximum(os.cpu_count() or 1)
+        self.workers_spinbox.setValue(1)
+        self.layout().addWidget(self.workers_spinbox)
+
+        # Mode en direct : mise à jour de la couche Tenants lors des modifications
+        self.live_checkbox = QCheckBox("Mettre à jour la couche Tenants lors des modifications de la couche")
+        self.layout().addWidget(self.live_checkbox)
+
         # Bouton pour exécuter le traitement
         self.process_button = QPushButton("Attribuer les Tenants")
         self.process_button.clicked.connect(self.process)
@@ -96,174 +941,109 @@ class TenantProcessorDialog(QDialog):
         additional_fields = self.get_selected_fields()
         expression = self.expression_input.text()
         distance = self.distance_spinbox.value()
+        workers = self.workers_spinbox.value()
 
         if not nom_bloc_field:
             QMessageBox.warning(self, "Avertissement", "Veuillez sélectionner un champ pour le nom du bloc.")
             return
 
-        # Filtrer les entités en fonction de l'expression
-        if expression:
-            expr = QgsExpression(expression)
-            if expr.hasParserError():
-                QMessageBox.warning(self, "Avertissement", f"Erreur dans l'expression : {expr.parserErrorString()}")
-                return
-            request = QgsFeatureRequest(expr)
-            filtered_features = [f for f in selected_layer.getFeatures(request)]
-        else:
-            filtered_features = list(selected_layer.getFeatures())
-
-        if not filtered_features:
+        # Filtrer les entités en fonction de l'expression (calcul dans la base pour une couche PostGIS)
+        try:
+            records = compute_layer_tenants(selected_layer, nom_bloc_field, distance, additional_fields, expression,
+                                            workers=workers)
+        except ValueError as e:
+            QMessageBox.warning(self, "Avertissement", str(e))
+            return
+        if not records:
             QMessageBox.warning(self, "Avertissement", "Aucune entité ne correspond à l'expression de filtrage.")
             return
 
-        # Utiliser le CRS de la couche d'entrée
-        input_crs = selected_layer.crs()
-
-        # Créer une nouvelle couche en mémoire avec le CRS de la couche d'entrée
-        mem_layer = QgsVectorLayer("Polygon", "Tenants", "memory")
-        mem_layer.setCrs(input_crs)
-
-        # Ajouter les champs à la nouvelle couche
-        fields_to_add = [
-            QgsField('tenant', QVariant.Int),
-            QgsField('blocs_partages', QVariant.String),
-            QgsField('id_original', QVariant.Int),
-            QgsField('superficie_bloc', QVariant.Double),
-            QgsField('superficie_tenant', QVariant.Double),
-            QgsField('pourcentage_superficie', QVariant.Double)
-        ]
-        for field_name in additional_fields:
-            field = selected_layer.fields().field(field_name)
-            fields_to_add.append(QgsField(field.name(), field.type()))
-
-        mem_layer.dataProvider().addAttributes(fields_to_add)
-        mem_layer.updateFields()
-
-        # Initialiser un dictionnaire pour les tenants
-        tenant_dict = {}
-        tenant_id = 1
-        tenant_blocs = {}
-        tenant_areas = {}
-
-        # Première passe : Attribuer les tenants en fonction de la proximité des périmètres
-        for feature in filtered_features:
-            geom = feature.geometry()
-            if not geom or geom.isNull() or not geom.isGeosValid():
-                print(f"Géométrie invalide pour l'entité ID: {feature.id()}")
-                continue
+        # Créer la couche des tenants avec le CRS de la couche d'entrée et l'ajouter au projet
+        fields = tenant_fields(selected_layer.fields(), additional_fields)
+        try:
+            mem_layer = create_tenant_layer(records, fields, selected_layer.crs())
+        except RuntimeError as e:
+            QMessageBox.warning(self, "Avertissement", str(e))
+            return
+        QgsProject.instance().addMapLayer(mem_layer)
+        if self.live_checkbox.isChecked():
+            _live_sessions.append(LiveTenants(selected_layer, mem_layer, nom_bloc_field, distance,
+                                              additional_fields, expression))
+
+        QMessageBox.information(self, "Succès", "Les tenants ont été attribués avec succès et la nouvelle couche 'Tenants' a été ajoutée au projet.")
+        self.close()
 
-            nom_bloc = feature[nom_bloc_field]  # Utiliser le champ sélectionné
-            bloc_area = geom.area() / 10000  # Convertir en hectares
-
-            assigned = False
-            # Vérifier si l'entité est proche d'une entité d'un tenant existant
-            for other_feature in filtered_features:
-                if other_feature.id() != feature.id():
-                    other_geom = other_feature.geometry()
-                    if geom.distance(other_geom) <= distance:
-                        if other_feature.id() in tenant_dict:
-                            tenant = tenant_dict[other_feature.id()]
-                        else:
-                            tenant = tenant_id
-                            tenant_id += 1
-
-                        tenant_dict[feature.id()] = tenant
-                        tenant_blocs[tenant] = tenant_blocs.get(tenant, []) + [nom_bloc]
-                        tenant_areas[tenant] = tenant_areas.get(tenant, 0) + bloc_area
-                        assigned = True
-                        break
-
-            # Si l'entité n'a pas été assignée à un tenant existant, créer un nouveau tenant
-            if not assigned:
-                tenant_dict[feature.id()] = tenant_id
-                tenant_blocs[tenant_id] = [nom_bloc]
-                tenant_areas[tenant_id] = bloc_area
-                tenant_id += 1
-
-        # Deuxième passe : Valider et ajuster les attributions de tenants
-        for feature in filtered_features:
-            geom = feature.geometry()
-            if not geom or geom.isNull() or not geom.isGeosValid():
-                continue
 
-            current_tenant = tenant_dict.get(feature.id())
-            for other_feature in filtered_features:
-                if other_feature.id() != feature.id():
-                    other_geom = other_feature.geometry()
-                    if geom.distance(other_geom) <= distance:
-                        other_tenant = tenant_dict.get(other_feature.id())
-                        if other_tenant and other_tenant != current_tenant:
-                            # Changer l'attribution du tenant si nécessaire
-                            tenant_dict[feature.id()] = other_tenant
-                            tenant_blocs[other_tenant].append(feature[nom_bloc_field])
-                            tenant_areas[other_tenant] += geom.area() / 10000
-                            if current_tenant in tenant_blocs:
-                                tenant_blocs[current_tenant].remove(feature[nom_bloc_field])
-                                tenant_areas[current_tenant] -= geom.area() / 10000
-                            break
-
-        # Ajouter les entités avec les champs 'tenant', 'blocs_partages', 'id_original', et les calculs de superficie à la nouvelle couche
-        mem_layer.startEditing()
-        for feature in filtered_features:
-            if feature.id() not in tenant_dict:
-                print(f"Entité ID {feature.id()} n'a pas été attribuée à un tenant.")
+def main(argv=None):
+    """Point d'entrée en ligne de commande : une couche de tenants (GeoPackage) par couche d'entrée."""
+    parser = argparse.ArgumentParser(description="Attribue des tenants aux blocs de récolte, sans interface.")
+    parser.add_argument("couches", nargs="+", help="Fichiers (ou sources OGR) des blocs de récolte")
+    parser.add_argument("--postgres", action="store_true",
+                        help="Les couches sont des URI PostgreSQL (calcul des tenants dans la base)")
+    parser.add_argument("--champ-nom", required=True, help="Champ contenant le nom du bloc")
+    parser.add_argument("--distance", type=float, default=60, help="Distance pour le calcul des tenants (m)")
+    parser.add_argument("--champs", nargs="*", default=[], help="Champs supplémentaires à conserver")
+    parser.add_argument("--filtre", default="", help="Expression de filtrage des entités")
+    parser.add_argument("--sortie", required=True, help="Dossier des couches de tenants")
+    parser.add_argument("--processus", type=int, default=1, help="Nombre de processus (calcul par tuiles)")
+    args = parser.parse_args(argv)
+
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    failures = 0
+    try:
+        os.makedirs(args.sortie, exist_ok=True)
+        for path in args.couches:
+            if args.postgres:
+                uri = QgsDataSourceUri(path)
+                layer = QgsVectorLayer(path, f"{uri.schema() or 'public'}_{uri.table()}", "postgres")
+            else:
+                layer = QgsVectorLayer(path, os.path.splitext(os.path.basename(path))[0], "ogr")
+            if not layer.isValid():
+                print(f"[ERREUR] Couche invalide ou inaccessible : {path}")
+                failures += 1
+                continue
+            missing = [name for name in [args.champ_nom] + args.champs if layer.fields().indexOf(name) < 0]
+            if missing:
+                print(f"[ERREUR] Champs absents de {path} : {', '.join(missing)}")
+                failures += 1
                 continue
+            try:
+                records = compute_layer_tenants(layer, args.champ_nom, args.distance, args.champs, args.filtre,
+                                                workers=args.processus)
+            except ValueError as e:
+                print(f"[ERREUR] {e}")
+                return 2
 
-            tenant = tenant_dict[feature.id()]
-            blocs_partages = ', '.join(map(str, set(tenant_blocs[tenant])))  # Convertir les éléments en chaînes de caractères
-            bloc_area = feature.geometry().area() / 10000  # Convertir en hectares
-            tenant_area = tenant_areas[tenant]
-            pourcentage_superficie = (bloc_area / tenant_area) * 100 if tenant_area > 0 else 0
-
-            attributes = [
-                tenant,
-                blocs_partages,
-                feature.id(),
-                bloc_area,
-                tenant_area,
-                pourcentage_superficie
-            ]
-
-            # Ajouter les valeurs des champs supplémentaires
-            for field_name in additional_fields:
-                value = feature[field_name]
-                attributes.append(value if value is not None else NULL)
-
-            new_feature = QgsFeature()
-            new_feature.setGeometry(feature.geometry())
-            new_feature.setAttributes(attributes)
-            mem_layer.addFeature(new_feature)
-        mem_layer.commitChanges()
-
-        # Appliquer une symbologie catégorisée par tenant avec des couleurs distinctes
-        renderer = QgsCategorizedSymbolRenderer('tenant')
-        renderer.setClassAttribute('tenant')
-
-        # Créer des catégories avec des couleurs distinctes
-        categories = []
-        colors = ['#ff0000', '#00ff00', '#0000ff', '#ffff00', '#ff00ff', '#00ffff']
-        for tenant_id, tenant_bloc in tenant_blocs.items():
-            symbol = QgsSymbol.defaultSymbol(mem_layer.geometryType())
-            color = QColor(colors[tenant_id % len(colors)])
-            symbol.setColor(color)
-            category = QgsRendererCategory(str(tenant_id), symbol, str(tenant_id))  # Convertir tenant_id en str
-            categories.append(category)
-
-        # Assigner les catégories directement à l'attribut categories
-        renderer.categories = categories
-        mem_layer.setRenderer(renderer)
-        mem_layer.triggerRepaint()
-
-        # Ajouter la nouvelle couche au projet QGIS
-        QgsProject.instance().addMapLayer(mem_layer)
+            out_path = os.path.join(args.sortie, f"{layer.name()}_tenants.gpkg")
+            fields = tenant_fields(layer.fields(), args.champs)
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = "GPKG"
+            options.fileEncoding = "UTF-8"
+            writer = QgsVectorFileWriter.create(out_path, fields, layer.wkbType(), layer.crs(),
+                                                QgsCoordinateTransformContext(), options)
+            written = (writer.hasError() == QgsVectorFileWriter.NoError
+                       and write_tenant_features(writer, records, fields))
+            error = writer.errorMessage()
+            del writer  # Ferme le fichier
+            if not written:
+                print(f"[ERREUR] Écriture de {out_path} : {error}")
+                failures += 1
+                continue
+            tenant_count = len({record.tenant for record in records})
+            print(f"[SUCCES] {path} : {len(records)} blocs, {tenant_count} tenants -> {out_path}")
+    finally:
+        qgs.exitQgis()
+    return 1 if failures else 0
 
-        QMessageBox.information(self, "Succès", "Les tenants ont été attribués avec succès et la nouvelle couche 'Tenants' a été ajoutée au projet.")
-        self.close()
 
-# Exécuter le script dans QGIS
-layers = [layer for layer in QgsProject.instance().mapLayers().values() if isinstance(layer, QgsVectorLayer)]
-if layers:
-    dialog = TenantProcessorDialog(layers)
-    dialog.exec_()
-else:
-    QMessageBox.warning(None, "Avertissement", "Aucune couche vectorielle disponible dans le projet.")
+# Exécuter le script dans QGIS (la console Python définit `iface` ; rien ne s'ouvre si le module est importé)
+if "iface" in globals():
+    layers = [layer for layer in QgsProject.instance().mapLayers().values() if isinstance(layer, QgsVectorLayer)]
+    if layers:
+        dialog = TenantProcessorDialog(layers)
+        dialog.exec_()
+    else:
+        QMessageBox.warning(None, "Avertissement", "Aucune couche vectorielle disponible dans le projet.")
+elif __name__ == "__main__":
+    sys.exit(main())